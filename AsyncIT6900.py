@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""asyncio variant of IT6900 driver"""
+import asyncio
+import time
+
+from IT6900 import IT6900, LF, convert_value, open_com_port
+
+from log_exception import log_exception
+from config_logger import config_logger
+
+
+class AsyncIT6900:
+    ID_OK = IT6900.ID_OK
+    DEVICE_NAME = IT6900.DEVICE_NAME
+    DEVICE_FAMILY = IT6900.DEVICE_FAMILY
+    STATUS_QUERIES = IT6900.STATUS_QUERIES
+    STATUS_TYPES = IT6900.STATUS_TYPES
+
+    def __init__(self, port: str, *args, **kwargs):
+        # no I/O here, call and await init() to open port and identify device
+        self.args = args
+        self.kwargs = kwargs
+        self.port = port.strip()
+        self.logger = kwargs.get('logger', config_logger())
+        self.retries = kwargs.get('retries', 2)
+        self.read_timeout = kwargs.get('read_timeout', 0.3)
+        self.poll_interval = kwargs.get('poll_interval', 0.002)
+        self.suspend_to = 0.0
+        self.suspend_delay = kwargs.get('suspend_delay', 6.0)
+        self.response = b''
+        self.buffer = bytearray()
+        self.lock = asyncio.Lock()
+        # one recovery at a time, other callers wait for its result
+        self.recovery_lock = asyncio.Lock()
+        self.com = None
+        self.id = 'Unknown Device'
+        self.type = 'Unknown Device'
+        self.sn = ''
+        self.pre = f'{self.id} {self.port} '
+        self.max_voltage = float('inf')
+        self.max_current = float('inf')
+        self.initialized_flag = False
+        self.io_count = 0
+        self.io_error_count = 0
+
+    def open_com_port(self):
+        # blocking, executed in default executor
+        return open_com_port(self.port, *self.args, **self.kwargs)
+
+    def close_com_port(self):
+        self.initialized_flag = False
+        try:
+            if self.com is not None:
+                self.com.close()
+        except KeyboardInterrupt:
+            raise
+        except:
+            log_exception(self.logger, f'{self.pre} COM port close exception')
+        self.com = None
+
+    async def init(self):
+        if self.com is None:
+            loop = asyncio.get_running_loop()
+            try:
+                self.com = await loop.run_in_executor(None, self.open_com_port)
+            except KeyboardInterrupt:
+                raise
+            except:
+                log_exception(self.logger, f'{self.pre} COM port open exception')
+                self.suspend()
+                return False
+        await self.send_command(b'SYST:REM', False, False)
+        await self.send_command(b'*CLS', False, False)
+        if not await self.send_command(b'*IDN?', True, False):
+            self.suspend()
+            self.logger.error(f'{self.pre}  Initialization error')
+            return False
+        self.id = self.response[:-1].decode(errors='replace')
+        if not self.id.startswith(self.ID_OK):
+            self.suspend()
+            self.logger.error(f'{self.pre}  Initialization error')
+            return False
+        items = self.id.split(',')
+        self.type = items[1].strip() if len(items) > 1 else 'Unknown Device'
+        self.sn = items[2].strip() if len(items) > 2 else ''
+        self.pre = f'{self.type} at {self.port} '
+        self.initialized_flag = True
+        self.suspend_to = 0.0
+        max_voltage, max_current = await self.query_many([b'VOLT? MAX', b'CURR? MAX'])
+        if max_voltage is not None:
+            self.max_voltage = max_voltage
+        else:
+            self.logger.warning(f'{self.pre} Max voltage can not be determined')
+        if max_current is not None:
+            self.max_current = max_current
+        else:
+            self.logger.warning(f'{self.pre} Max current can not be determined')
+        self.logger.debug(f'{self.pre} Device has been initialized')
+        return True
+
+    @property
+    def ready(self):
+        return self.initialized_flag and time.perf_counter() >= self.suspend_to
+
+    def initialized(self):
+        return self.ready
+
+    def suspend(self):
+        if time.perf_counter() < self.suspend_to:
+            return
+        self.initialized_flag = False
+        self.suspend_to = time.perf_counter() + self.suspend_delay
+        self.logger.debug(f'{self.pre} Suspended for {self.suspend_delay} s')
+
+    async def reconnect(self):
+        # port is not closed under command in progress
+        async with self.lock:
+            self.close_com_port()
+        return await self.init()
+
+    async def recover(self):
+        # re-init after suspend expiration, concurrent callers share one attempt
+        # returns ready
+        async with self.recovery_lock:
+            if self.ready:
+                return True
+            if time.perf_counter() < self.suspend_to:
+                # attempt of other caller has failed
+                return False
+            return await self.reconnect()
+
+    async def send_command(self, command,
+                           check_response: bool = None,
+                           check_ready: bool = True) -> bool:
+        # same as IT6900.send_command but does not block event loop
+        if check_ready and not self.ready:
+            if time.perf_counter() < self.suspend_to or not await self.recover():
+                return False
+        if isinstance(command, str):
+            command = command.encode()
+        command = command.upper().strip()
+        if not command.endswith(LF):
+            command += LF
+        if check_response is None:
+            check_response = b'?' in command
+        async with self.lock:
+            self.io_count += 1
+            t0 = time.perf_counter()
+            result = False
+            try:
+                for n in range(self.retries):
+                    self.response = b''
+                    if not self.write(command):
+                        continue
+                    if not check_response:
+                        result = True
+                        break
+                    self.response = await self.read_until(LF)
+                    if self.response.endswith(LF):
+                        result = True
+                        break
+                    self.io_error_count += 1
+            except KeyboardInterrupt:
+                raise
+            except:
+                self.io_error_count += 1
+                log_exception(self.logger, f'{self.pre} Command {command} exception')
+            dt = time.perf_counter() - t0
+        if not result:
+            self.suspend()
+            self.logger.info(f'{self.pre} I/O ERROR {command} -> {self.response}, %4.0f ms', dt * 1000)
+        return result
+
+    def write(self, cmd):
+        try:
+            self.buffer.clear()
+            self.com.reset_input_buffer()
+            self.com.reset_output_buffer()
+            length = self.com.write(cmd)
+            if len(cmd) != length:
+                self.logger.error(f'{self.pre} Write error %s of %s' % (length, len(cmd)))
+                return False
+            return True
+        except KeyboardInterrupt:
+            raise
+        except:
+            log_exception(self.logger, f'{self.pre} Exception during write')
+            return False
+
+    async def read_until(self, terminator=LF, timeout=None):
+        # wait for terminator yielding to event loop while no input is available
+        if timeout is None:
+            timeout = self.read_timeout
+        end_time = time.perf_counter() + timeout
+        while True:
+            i = self.buffer.find(terminator)
+            if i >= 0:
+                n = i + len(terminator)
+                break
+            k = self.com.in_waiting
+            if k > 0:
+                r = self.com.read(k)
+                if r:
+                    self.buffer += r
+                    continue
+            if time.perf_counter() > end_time:
+                self.logger.debug('%s read timeout', self.pre)
+                n = len(self.buffer)
+                break
+            await asyncio.sleep(self.poll_interval)
+        result = bytes(self.buffer[:n])
+        del self.buffer[:n]
+        return result
+
+    def convert_value(self, value: bytes, v_type=float):
+        return convert_value(value, v_type, self.logger)
+
+    async def read_value(self, cmd, v_type=float):
+        if await self.send_command(cmd):
+            return self.convert_value(self.response, v_type)
+        return None
+
+    async def query_many(self, commands, v_types=None):
+        # see IT6900.query_many
+        commands = [c.encode() if isinstance(c, str) else c for c in commands]
+        commands = [c.upper().strip() for c in commands]
+        if v_types is None:
+            v_types = [float] * len(commands)
+        v_types = list(v_types)
+        values = [None] * len(commands)
+        if len(commands) > 1 and await self.send_command(b';'.join(commands), True):
+            parts = self.response[:-1].split(b';')
+            if len(parts) == len(commands):
+                values = [self.convert_value(r, t) for r, t in zip(parts, v_types)]
+        for i in range(len(commands)):
+            if values[i] is None:
+                values[i] = await self.read_value(commands[i], v_types[i])
+        return values
+
+    async def read_all(self):
+        values = await self.query_many(self.STATUS_QUERIES.values(), self.STATUS_TYPES.values())
+        return dict(zip(self.STATUS_QUERIES.keys(), values))
+
+    async def write_value(self, cmd, value):
+        if isinstance(cmd, str):
+            cmd = cmd.encode()
+        cmd1 = cmd.upper().strip()
+        v = await self.read_value(cmd1 + b' ' + str(value).encode() + b';' + cmd1 + b'?', type(value))
+        return value == v
+
+    async def write_output(self, value: bool):
+        return await self.send_command(b'OUTP ON' if value else b'OUTP OFF', False)
+
+    async def write_voltage(self, value: float):
+        return await self.write_value(b'VOLT', value)
+
+    async def write_current(self, value: float):
+        return await self.write_value(b'CURR', value)
+
+    async def read_output(self):
+        return await self.read_value(b'OUTP?', bool)
+
+    async def read_current(self):
+        return await self.read_value(b'MEAS:CURR?')
+
+    async def read_programmed_current(self):
+        return await self.read_value(b'CURR?')
+
+    async def read_voltage(self):
+        return await self.read_value(b'MEAS:VOLT?')
+
+    async def read_programmed_voltage(self):
+        return await self.read_value(b'VOLT?')
+
+    async def read_power(self):
+        return await self.read_value(b'MEAS:POW?')
+
+    async def read_errors(self):
+        if await self.send_command(b'SYST:ERR?'):
+            return self.response[:-1].decode()
+        return ''
+
+
+async def init_all(devices):
+    # initialize devices concurrently, returns list of init results
+    return await asyncio.gather(*(d.init() for d in devices))
+
+
+async def read_all(devices):
+    # read status of all devices concurrently, time is limited by the slowest device
+    return await asyncio.gather(*(d.read_all() for d in devices))
+
+
+if __name__ == "__main__":
+    async def main():
+        devices = [AsyncIT6900(p, baudrate=115200) for p in ("COM3", "COM4", "COM5")]
+        await init_all(devices)
+        t_0 = time.perf_counter()
+        values = await read_all(devices)
+        dt = (time.perf_counter() - t_0) * 1000.0
+        for d, v in zip(devices, values):
+            print(d.port, v)
+        print('Cycle time %4.0f ms' % dt)
+
+    asyncio.run(main())
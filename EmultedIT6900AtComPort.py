@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 
+import random
 import time
+from collections import deque
 from threading import Lock
 
 from config_logger import config_logger
@@ -16,6 +18,12 @@ class EmultedIT6900AtComPort:
     SN = 123456
     RESPONSE_DELAY = 0.035
     ID = 'ITECH Ltd., IT6900EMULATED,  800774011776810024,  1.14-1.08'
+    # processing time of commands in realistic mode, s
+    DEFAULT_COMMAND_DELAY = 0.010
+    COMMAND_DELAYS = {b'*IDN?': 0.030, b'*SN?': 0.020, b'SYST:ERR?': 0.015,
+                      b'MEAS:VOLT?': 0.025, b'MEAS:CURR?': 0.025, b'MEAS:POW?': 0.030,
+                      b'VOLT?': 0.005, b'CURR?': 0.005, b'OUTP?': 0.005,
+                      b'VOLT': 0.008, b'CURR': 0.008, b'OUTP': 0.015, b'ADDR': 0.001}
 
     def __init__(self, port, *args, **kwargs):
         self.logger = kwargs.get('logger', config_logger())
@@ -33,10 +41,36 @@ class EmultedIT6900AtComPort:
         self.id = {}
         self.t = {}
         self.write_error = False
+        # addresses of emulated devices at the bus, None - any address
+        self.addresses = kwargs.get('addresses', None)
+        # response to the last write
+        self.response = b''
+        # realistic mode: byte timing from baud rate, output FIFO, per command delays
+        self.realistic = kwargs.get('realistic', False)
+        self.baudrate = kwargs.get('baudrate', 115200)
+        # time of one byte, 10 bits per byte for 8N1
+        self.byte_time = 10.0 / self.baudrate
+        self.command_delays = dict(self.COMMAND_DELAYS)
+        self.command_delays.update(kwargs.get('command_delays', {}))
+        # random additional delay up to jitter, s
+        self.jitter = kwargs.get('jitter', 0.0)
+        # probability to lose whole response
+        self.drop_rate = kwargs.get('drop_rate', 0.0)
+        self.random = random.Random(kwargs.get('seed', None))
+        # output FIFO: [time of the first byte, bytes]
+        self.fifo = deque()
+        # device is busy until this time
+        self.busy_to = 0.0
         self.add_device()
+        for a in self.addresses or ():
+            self.last_address = a
+            self.add_device()
+        self.last_address = -1
 
     def close(self):
         self.last_write = b''
+        self.response = b''
+        self.fifo.clear()
         self.online = False
         return True
 
@@ -49,107 +83,169 @@ class EmultedIT6900AtComPort:
             self.mc[self.last_address] = 0.0
             self.out[self.last_address] = False
             self.sn[self.last_address] = str(EmultedIT6900AtComPort.SN).encode()
+            self.t[self.last_address] = 0.0
             EmultedIT6900AtComPort.SN += 1
 
     def write(self, cmd, timeout=None):
-        self.last_write = cmd
-        self.write_error = False
-        commands = cmd[:-1].split(b';')
-        for c in commands:
-            try:
-                if c.startswith(b'ADDR '):
-                    self.last_address = int(self.last_write[5:])
-                    self.add_device()
-                elif c.startswith(b'VOLT '):
-                    self.pv[self.last_address] = float(c[5:])
-                elif c.startswith(b'CURR '):
-                    self.pc[self.last_address] = float(c[5:])
-                elif c.startswith(b'OUTP ON') or c.startswith(b'OUTP 1'):
-                    self.out[self.last_address] = True
-                elif c.startswith(b'OUTP OF') or c.startswith(b'OUTP 0'):
-                    self.out[self.last_address] = False
-                else:
-                    if c not in COMMANDS:
-                        self.write_error = True
-                self.t[self.last_address] = time.perf_counter()
-                return len(cmd)
-            except:
-                log_exception(self)
-                self.write_error = True
-                self.t[self.last_address] = time.perf_counter()
-                return len(cmd)
-        self.last_write = commands[-1]
+        with self.lock:
+            self.last_write = cmd
+            self.write_error = False
+            responses = []
+            delay = 0.0
+            for c in cmd.strip().split(b';'):
+                c = c.strip()
+                try:
+                    r = self.execute(c)
+                except KeyboardInterrupt:
+                    raise
+                except:
+                    log_exception(self.logger, f'Emulator command {c} exception')
+                    self.write_error = True
+                    r = None
+                if r is not None:
+                    responses.append(r)
+                delay += self.command_delays.get(c.split(b' ', 1)[0], self.DEFAULT_COMMAND_DELAY)
+            self.t[self.last_address] = time.perf_counter()
+            self.response = b';'.join(responses) + LF if responses else b''
+            if self.addresses is not None and self.last_address not in self.addresses:
+                # no device at selected address
+                self.response = b''
+            if self.realistic:
+                self.schedule(len(cmd), delay)
+            return len(cmd)
+
+    def schedule(self, length, delay):
+        # put response to output FIFO with serial timing
+        now = time.perf_counter()
+        if self.jitter > 0.0:
+            delay += self.random.uniform(0.0, self.jitter)
+        # device receives the command, then processes it after the previous one
+        start = max(now + length * self.byte_time, self.busy_to) + delay
+        response = self.response
+        self.response = b''
+        if not response:
+            self.busy_to = start
+            return
+        if self.drop_rate > 0.0 and self.random.random() < self.drop_rate:
+            self.busy_to = start
+            return
+        self.fifo.append([start, bytearray(response)])
+        self.busy_to = start + len(response) * self.byte_time
+
+    def execute(self, c):
+        # execute single command, returns response without LF or None
+        a = self.last_address
+        if c.startswith(b'ADDR '):
+            self.last_address = int(c[5:])
+            self.add_device()
+            return None
+        if c.startswith(b'VOLT? MAX'):
+            return b'60.0'
+        if c.startswith(b'CURR? MAX'):
+            return b'10.0'
+        if c.startswith(b'VOLT '):
+            self.pv[a] = float(c[5:])
+            return None
+        if c.startswith(b'CURR '):
+            self.pc[a] = float(c[5:])
+            return None
+        if c.startswith(b'OUTP ON') or c.startswith(b'OUTP 1'):
+            self.out[a] = True
+            return None
+        if c.startswith(b'OUTP OF') or c.startswith(b'OUTP 0'):
+            self.out[a] = False
+            return None
+        if c.startswith(b'MEAS:POW?'):
+            self.measure_voltage(a)
+            self.measure_current(a)
+            return str(self.mv[a] * self.mc[a]).encode()
+        if c.startswith(b'VOLT?'):
+            return str(self.pv[a]).encode()
+        if c.startswith(b'MEAS:VOLT?'):
+            return str(self.measure_voltage(a)).encode()
+        if c.startswith(b'CURR?'):
+            return str(self.pc[a]).encode()
+        if c.startswith(b'MEAS:CURR?'):
+            return str(self.measure_current(a)).encode()
+        if c.startswith(b'*IDN?'):
+            return b'ITECH Ltd., IT6932EMULATED, 800774011776810024,  1.14-1.08'
+        if c.startswith(b'*SN?'):
+            return self.sn[a]
+        if c.startswith(b'OUTP?'):
+            return b'ON' if self.out[a] else b'OFF'
+        if c.startswith(b'SYST:ERR?'):
+            return b'Unknown command' if self.write_error else b'No error'
+        if c not in COMMANDS:
+            self.write_error = True
+        return None
+
+    def measure_voltage(self, a):
+        if self.out[a]:
+            self.mv[a] = self.pv[a]
+        else:
+            self.mv[a] += 0.5
+            if self.mv[a] > 10.0:
+                self.mv[a] = 0.0
+        return self.mv[a]
+
+    def measure_current(self, a):
+        if self.out[a]:
+            self.mc[a] = self.pc[a]
+        else:
+            self.mc[a] += 1.0
+            if self.mc[a] > 100.0:
+                self.mc[a] = 0.0
+        return self.mc[a]
+
+    def available(self, now=None):
+        # number of bytes received by host in realistic mode
+        if now is None:
+            now = time.perf_counter()
+        n = 0
+        for start, data in self.fifo:
+            if now < start:
+                break
+            k = int((now - start) / self.byte_time) + 1
+            if k < len(data):
+                return n + k
+            n += len(data)
+        return n
 
     def read(self, size=1, timeout=None):
-        if self.last_write == b'':
-            return b''
-        if time.perf_counter() - self.t[self.last_address] < self.RESPONSE_DELAY:
-            return b''
-        self.t[self.last_address] = time.perf_counter()
-        # if self.write_error:
-        #     self.last_write = b''
-        #     return b''
-        # if self.last_write.startswith(b'ADR '):
-        #     self.last_write = b''
-        #     return b'OK\r'
-        if self.last_write.startswith(b'VOLT? MAX'):
-            self.last_write = b''
-            return b'60.0\n'
-        if self.last_write.startswith(b'CURR? MAX'):
-            self.last_write = b''
-            return b'10.0\n'
-        if self.last_write.startswith(b'MEAS:POW?'):
-            if self.out[self.last_address]:
-                self.mv[self.last_address] = self.pv[self.last_address]
-            else:
-                self.mv[self.last_address] += 0.5
-                if self.mv[self.last_address] > 10.0:
-                    self.mv[self.last_address] = 0.0
-            self.last_write = b''
-            return str(self.mv[self.last_address]).encode() + LF
-        if self.last_write.startswith(b'VOLT?'):
+        with self.lock:
+            if self.realistic:
+                return self.read_fifo(size)
+            if self.response == b'':
+                return b''
+            if time.perf_counter() - self.t[self.last_address] < self.RESPONSE_DELAY:
+                return b''
+            self.t[self.last_address] = time.perf_counter()
+            result = self.response
+            self.response = b''
             self.last_write = b''
-            return str(self.pv[self.last_address]).encode() + LF
-        if self.last_write.startswith(b'MEAS:VOLT?'):
-            if self.out[self.last_address]:
-                self.mv[self.last_address] = self.pv[self.last_address]
-            else:
-                self.mv[self.last_address] += 0.5
-                if self.mv[self.last_address] > 10.0:
-                    self.mv[self.last_address] = 0.0
-            self.last_write = b''
-            return str(self.mv[self.last_address]).encode() + LF
-        if self.last_write.startswith(b'CURR?'):
-            self.last_write = b''
-            return str(self.pc[self.last_address]).encode() + LF
-        if self.last_write.startswith(b'MEAS:CURR?'):
-            if self.out[self.last_address]:
-                self.mc[self.last_address] = self.pc[self.last_address]
-            else:
-                self.mv[self.last_address] += 1.0
-                if self.mv[self.last_address] > 100.0:
-                    self.mv[self.last_address] = 0.0
-            self.last_write = b''
-            return str(self.mv[self.last_address]).encode() + LF
-        if self.last_write.startswith(b'*IDN?'):
-            self.last_write = b''
-            return b'ITECH Ltd., IT6932EMULATED, 800774011776810024,  1.14-1.08\n'
-        if self.last_write.startswith(b'OUTP?'):
-            self.last_write = b''
-            if self.out[self.last_address]:
-                return b'ON\n'
-            else:
-                return b'OFF\n'
-        if self.last_write.startswith(b'SYST:ERR?'):
-            self.last_write = b''
-            if self.write_error:
-                return b'Unknown command\n'
+            return result
+
+    def read_fifo(self, size):
+        n = min(size, self.available())
+        result = bytearray()
+        while n > 0:
+            start, data = self.fifo[0]
+            k = min(n, len(data))
+            result += data[:k]
+            del data[:k]
+            n -= k
+            if data:
+                # rest of the chunk continues after the bytes read
+                self.fifo[0][0] = start + k * self.byte_time
             else:
-                return b'No error\n'
-        self.last_write = b''
-        return b''
+                self.fifo.popleft()
+        return bytes(result)
 
     def reset_input_buffer(self, timeout=None):
+        if self.realistic:
+            # discard bytes already received, bytes in transit will arrive later
+            with self.lock:
+                self.read_fifo(self.available())
         return True
 
     def reset_output_buffer(self, timeout=None):
@@ -160,4 +256,6 @@ class EmultedIT6900AtComPort:
 
     @property
     def in_waiting(self):
+        if self.realistic:
+            return self.available()
         return 1
@@ -1,13 +1,24 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import json
+import logging
+import os
+import tempfile
 import time
-import sys;
-from multiprocessing import Lock
+import sys
+from threading import Event, Lock, RLock, Thread
 
-sys.path.append('../TangoUtils')
+if os.path.realpath('../TangoUtils') not in sys.path: sys.path.append(os.path.realpath('../TangoUtils'))
 
-from EmultedIT6900AtComPort import EmultedIT6900AtComPort
 from ComPort import ComPort
+from IT6900_Bus import IT6900Bus
+from IT6900_Commands import COMMANDS, SLOW, Command, chain
+from IT6900_Registry import IT6900Registry, PortLock
+from IT6900_Stats import IOStats
+from IT6900_Trace import IOTrace
+from IT6900_Setpoint import SetpointWriter
+from IT6900_Transport import TRANSPORTS, RecordingTransport
+from IT6900_Ramp import Ramp
 
 from config_logger import config_logger
 from log_exception import log_exception
@@ -19,30 +30,112 @@ class IT6900Exception(Exception):
     pass
 
 
+def open_com_port(port: str, *args, **kwargs):
+    # open port for IT6900 and AsyncIT6900
+    # transport class from kwargs or by port prefix, e.g. 'tcp://192.168.1.10:5025'
+    transport = kwargs.get('transport')
+    scheme, sep, _ = port.partition('://')
+    if transport is None and sep:
+        transport = TRANSPORTS.get(scheme.lower())
+        if transport is None:
+            raise IT6900Exception(f'Unknown transport {scheme} for {port}')
+    if transport is not None:
+        com = transport(port, *args, **kwargs)
+    else:
+        # emulator module is loaded at first port opening, not at import
+        from EmultedIT6900AtComPort import EmultedIT6900AtComPort
+        com = ComPort(port, *args, emulated=EmultedIT6900AtComPort, **kwargs)
+    # append all port traffic to file for replay
+    record = kwargs.get('record')
+    if record:
+        com = RecordingTransport(com, record, logger=kwargs.get('logger', config_logger()))
+    return com
+
+
+def convert_value(value: bytes, v_type=float, logger=None):
+    # convert single response to v_type, returns None if not possible
+    try:
+        value = value.strip()
+        if v_type is bool:
+            value = value.upper()
+            if value in (b'ON', b'1'):
+                return True
+            if value in (b'OFF', b'0'):
+                return False
+            raise ValueError
+        return v_type(value)
+    except KeyboardInterrupt:
+        raise
+    except:
+        if logger is not None:
+            logger.debug('Can not convert %s to %s', value, v_type)
+        return None
+
+
 class IT6900:
     ID_OK = 'ITECH'
     DEVICE_NAME = 'IT6900'
     DEVICE_FAMILY = 'IT6900 family Power Supply'
-    _devices = []
+    ADDRESS_COMMAND = b'ADDR'
+    # appended to retries, reply with extra values is told apart from late reply of earlier attempt
+    RETRY_QUERY = b'OUTP?'
+    BAUDS = (115200, 9600, 4800, 19200, 38400, 57600)
+    # device states
+    OFFLINE = 'OFFLINE'
+    PROBING = 'PROBING'
+    ONLINE = 'ONLINE'
+    STATUS_QUERIES = {'voltage': b'MEAS:VOLT?', 'current': b'MEAS:CURR?', 'power': b'MEAS:POW?',
+                      'output': b'OUTP?', 'programmed_voltage': b'VOLT?', 'programmed_current': b'CURR?'}
+    STATUS_TYPES = {'voltage': float, 'current': float, 'power': float,
+                    'output': bool, 'programmed_voltage': float, 'programmed_current': float}
+    # precompiled commands for STATUS_QUERIES
+    STATUS_COMMANDS = tuple(COMMANDS[name] for name in STATUS_QUERIES)
+    # setpoint commands: write with read back, write only, read back
+    SET_COMMANDS = {b'VOLT': COMMANDS['set_voltage'], b'CURR': COMMANDS['set_current']}
+    WRITE_COMMANDS = {b'VOLT': COMMANDS['write_voltage'], b'CURR': COMMANDS['write_current']}
+    READ_COMMANDS = {b'VOLT': COMMANDS['programmed_voltage'], b'CURR': COMMANDS['programmed_current']}
+    # guards id cache
     _lock = Lock()
+    # max voltage and current of known devices by port, address and serial number
+    _id_cache = {}
 
     def __init__(self, port: str, *args, **kwargs):
         # defaults
         self.args = args
         self.kwargs = kwargs
         self.port = port.strip()
+        # address at shared bus, None for device with its own port
+        self.address = kwargs.get('address', None)
+        self.bus = None
+        # OS level lock of the port against other processes
+        self.port_lock = kwargs.get('port_lock', True)
+        self.lock_dir = kwargs.get('lock_dir', None)
+        self.port_locked = False
         # logger
         self.logger = kwargs.get('logger', config_logger())
         # timeout
         self.retries = kwargs.get('retries', 2)
         self.read_timeout = kwargs.get('read_timeout', 0.3)
+        # read timeout of SLOW commands until their latency is learned
+        self.slow_read_timeout = kwargs.get('slow_read_timeout', 1.0)
+        # adaptive read timeout per command: p99 latency * timeout_factor, from min_timeout to read_timeout
+        self.adaptive_timeout = kwargs.get('adaptive_timeout', True)
+        self.timeout_factor = kwargs.get('timeout_factor', 3.0)
+        self.min_timeout = kwargs.get('min_timeout', 0.02)
         self.read_timeout_time = float('inf')
+        # polling interval when no input is available
+        self.poll_interval = kwargs.get('poll_interval', 0.001)
         self.suspend_to = 0.0
         self.suspend_delay = kwargs.get('suspend_delay', 6.0)
+        self.max_suspend_delay = kwargs.get('max_suspend_delay', 60.0)
         self.reconnect_timeout_time = 0.0
         #
         self.command = b''
         self.response = b''
+        # serializes transactions from different threads
+        self.lock = RLock()
+        # input buffer, keeps bytes received after the last response
+        self.buffer = bytearray()
         # com port, id, and serial number
         self.com = None
         self.id = 'Unknown Device'
@@ -50,28 +143,56 @@ class IT6900:
         self.sn = ''
         # log prefix
         self.pre = f'{self.id} {self.port} '
+        # file to keep device limits between runs, None - do not keep
+        self.id_cache_file = kwargs.get('id_cache', None)
+        # max difference of written and read back setpoint
+        self.setpoint_tolerance = kwargs.get('setpoint_tolerance', 1e-3)
+        # coalescing setpoint writers by command
+        self.setpoint_writers = {}
+        # last started ramp
+        self.ramp_task = None
         # max values
         self.max_voltage = float('inf')
         self.max_current = float('inf')
-        #
-        self.ready = False
+        # recovery state machine
+        self.state = self.OFFLINE
+        self.closed = False
+        self.recovery_count = 0
+        self.recovery_thread = None
+        self.recovery_lock = RLock()
+        self.recovery_event = Event()
+        self.ready_event = Event()
         # io statistics
-        self.io_count = 0
-        self.io_error_count = 0
-        self.avg_io_time = 0.0
-        self.max_io_time = 0.0
-        self.min_io_time = 1000.0
+        self.io_stats = IOStats()
+        # ring of recent transactions, dumped on demand
+        self.trace = IOTrace(kwargs.get('trace_size', 256))
         #
+        # add to registry
+        old = IT6900Registry.register(self)
+        if old is not None and not old.closed:
+            self.logger.warning(f'{self.pre} Device at {self.port} address {self.address} is already in use')
+        if kwargs.get('background_init', False):
+            # open port and initialize device in recovery thread, do not wait
+            self.start_recovery()
+            return
         # create and open COM port
         self.com = self.create_com_port()
-        # add to list
-        with IT6900._lock:
-            if self not in IT6900._devices:
-                IT6900._devices.append(self)
-        # further initialization (for possible async use)
+        # further initialization
         self.init()
 
+    @classmethod
+    def get(cls, port: str, *args, **kwargs):
+        # returns existing open device at port and address or creates new one
+        device = IT6900Registry.find(port, kwargs.get('address', None))
+        if device is not None and not device.closed and isinstance(device, cls):
+            return device
+        return cls(port, *args, **kwargs)
+
     def init(self):
+        # port can not be opened or is locked by other process
+        if self.com is None:
+            self.suspend()
+            return False
         # switch to remote mode
         self.switch_remote()
         self.clear_status()
@@ -82,20 +203,23 @@ class IT6900:
             self.logger.error(f'{self.pre}  Initialization error')
             return False
         self.ready = True
-        # read serial number and type
-        self.sn = self.read_serial_number()
-        self.type = self.read_device_type()
+        # serial number and type from the same *IDN? response
+        self.type, self.sn = self.parse_device_id(self.id)
         self.pre = f'{self.type} at {self.port} '
-        # read maximal voltage and current
+        # maximal voltage and current, from cache or from device
         try:
-            if self.send_command(b'VOLT? MAX'):
-                self.max_voltage = float(self.response[:-1])
-            else:
-                self.logger.warning(f'{self.pre} Max voltage can not be determined')
-            if self.send_command(b'CURR? MAX'):
-                self.max_current = float(self.response[:-1])
-            else:
-                self.logger.warning(f'{self.pre} Max current can not be determined')
+            if not self.load_limits():
+                max_voltage, max_current = self.query_many([COMMANDS['max_voltage'], COMMANDS['max_current']])
+                if max_voltage is not None:
+                    self.max_voltage = max_voltage
+                else:
+                    self.logger.warning(f'{self.pre} Max voltage can not be determined')
+                if max_current is not None:
+                    self.max_current = max_current
+                else:
+                    self.logger.warning(f'{self.pre} Max current can not be determined')
+                if max_voltage is not None and max_current is not None:
+                    self.save_limits()
         except KeyboardInterrupt:
             raise
         except:
@@ -105,81 +229,244 @@ class IT6900:
         self.logger.debug(f'{self.pre} Device has been initialized')
         return True
 
+    def id_cache_key(self):
+        return f'{self.port}:{self.address}:{self.sn}'
+
+    def load_limits(self):
+        # get max voltage and current for the device from id cache
+        # returns True if found
+        record = self.get_id_cache(self.id_cache_key())
+        if record is None or record.get('id') != self.id:
+            return False
+        self.max_voltage = record['max_voltage']
+        self.max_current = record['max_current']
+        self.logger.debug(f'{self.pre} Limits from id cache')
+        return True
+
+    def save_limits(self):
+        record = {'id': self.id, 'max_voltage': self.max_voltage, 'max_current': self.max_current}
+        self.put_id_cache(self.id_cache_key(), record)
+
+    def get_id_cache(self, key):
+        with IT6900._lock:
+            record = IT6900._id_cache.get(key)
+            if record is None and self.id_cache_file:
+                IT6900._id_cache.update(self.read_id_cache_file())
+                record = IT6900._id_cache.get(key)
+        return record
+
+    def put_id_cache(self, key, record):
+        with IT6900._lock:
+            IT6900._id_cache[key] = record
+            if not self.id_cache_file:
+                return
+            # file may be shared by several processes: merge under lock file, write via private temp file
+            lock = PortLock(self.id_cache_file, file_name=self.id_cache_file + '.lock')
+            tmp = None
+            try:
+                lock.acquire(True)
+                data = self.read_id_cache_file()
+                data[key] = record
+                folder = os.path.dirname(os.path.abspath(self.id_cache_file))
+                fd, tmp = tempfile.mkstemp(prefix=os.path.basename(self.id_cache_file), suffix='.tmp', dir=folder)
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(data, f, indent=1)
+                os.replace(tmp, self.id_cache_file)
+                tmp = None
+            except KeyboardInterrupt:
+                raise
+            except:
+                log_exception(self.logger, f'{self.pre} Can not write id cache {self.id_cache_file}')
+            finally:
+                if tmp is not None and os.path.exists(tmp):
+                    os.remove(tmp)
+                lock.release()
+
+    def read_id_cache_file(self):
+        try:
+            with open(self.id_cache_file) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except KeyboardInterrupt:
+            raise
+        except:
+            log_exception(self.logger, f'{self.pre} Can not read id cache {self.id_cache_file}')
+            return {}
+
     def create_com_port(self):
-        self.com = ComPort(self.port, *self.args, emulated=EmultedIT6900AtComPort, **self.kwargs)
+        if self.address is None:
+            if not self.lock_port():
+                return None
+            self.com = self.open_com_port()
+        else:
+            self.bus = IT6900Bus.get(self.port, logger=self.logger)
+            self.lock = self.bus.lock
+            self.com = self.bus.attach(self)
         return self.com
 
+    def open_com_port(self):
+        return open_com_port(self.port, *self.args, **self.kwargs)
+
     def close_com_port(self):
         self.ready = False
         try:
-            self.com.close()
+            if self.bus is not None:
+                self.bus.detach(self)
+            elif self.com is not None:
+                self.com.close()
         except KeyboardInterrupt:
             raise
         except:
             log_exception(self.logger, f'{self.pre} COM port close exception')
+        if self.bus is None:
+            self.unlock_port()
+
+    def lock_port(self):
+        # take OS lock of the port, returns False if port is used by other process
+        if not self.port_lock or self.port_locked:
+            return True
+        if not IT6900Registry.lock_port(self.port, self.lock_dir):
+            pid = IT6900Registry.port_owner(self.port, self.lock_dir)
+            self.logger.error(f'{self.pre} Port {self.port} is locked by process {pid}')
+            return False
+        self.port_locked = True
+        return True
+
+    def unlock_port(self):
+        if self.port_locked:
+            IT6900Registry.unlock_port(self.port)
+            self.port_locked = False
 
     def send_command(self, command,
                      check_response: bool = None,
                      check_ready: bool = True) -> bool:
-        # command (bytes or str) - input command
+        # command (Command, bytes or str) - input command
         # check_response (bool or None) - if None check response if command contains b'?'
         # returns True or False
-        self.io_count += 1
-        try:
-            if check_ready and not self.ready:
-                return False
-            # convert str to bytes
-            if isinstance(command, str):
-                command = str.encode(command)
-            # unify command
-            command = command.upper().strip()
-            if not command.endswith(LF):
-                command += LF
-            #
-            result = False
-            n = self.retries
-            t0 = time.perf_counter()
-            while n > 0:
-                n -= 1
-                self.response = b''
+        # offline device does not wait for the lock held by recovery
+        if check_ready and not self.ready:
+            return False
+        with self.lock:
+            stats = self.io_stats
+            try:
+                if check_ready and not self.ready:
+                    return False
+                stats.io_count += 1
+                if command.__class__ is Command:
+                    # precompiled command, nothing to prepare
+                    verb = command.verb
+                    read_timeout = self.slow_read_timeout if command.latency == SLOW else self.read_timeout
+                    if check_response is None:
+                        check_response = command.query
+                    command = command.wire
+                else:
+                    verb = None
+                    read_timeout = self.read_timeout
+                    # convert str to bytes
+                    if isinstance(command, str):
+                        command = str.encode(command)
+                    # unify command
+                    command = command.upper().strip()
+                    if not command.endswith(LF):
+                        command += LF
+                    # check response
+                    if check_response is None:
+                        check_response = b'?' in command
+                #
+                result = False
+                n = self.retries
+                # first attempt waits for learned latency of the command, retry is sent at once after it
+                # and waits read_timeout, late replies of earlier attempts are told apart by retry tags
+                timeout = read_timeout
+                if self.adaptive_timeout and check_response:
+                    timeout = stats.timeout(command, read_timeout, self.timeout_factor, self.min_timeout, verb)
+                # send times and tags of attempts without reply
+                sent = []
+                wire = command
                 t0 = time.perf_counter()
-                # send command
-                if not self.write(command):
-                    continue
-                # check response
-                if check_response is None:
-                    if b'?' in command:
-                        check_response = True
+                while n > 0:
+                    if n < self.retries:
+                        stats.retry_count += 1
+                        timeout = read_timeout
+                    tags = sent[-1][1] + 1 if sent else 0
+                    if tags > 0:
+                        wire = command[:-1] + (b';' + self.RETRY_QUERY) * tags + LF
+                    n -= 1
+                    self.response = b''
+                    t0 = time.perf_counter()
+                    # select device at shared bus and send command,
+                    # input is not reset while replies of earlier attempts may come
+                    if (self.bus is not None and not self.bus.select(self)) or not self.write(wire, not sent):
+                        stats.io_error_count += 1
+                        self.trace.record(wire, b'', t0, time.perf_counter() - t0, False, self.retries - n)
+                        continue
+                    stats.bytes_out += len(wire)
+                    if not check_response:
+                        result = True
                     else:
-                        check_response = False
-                if not check_response:
-                    result = True
-                else:
-                    # read response (to LF by default)
-                    result = self.read_response()
-                # calculate time stats
+                        sent.append((t0, tags))
+                        # read response (to LF by default)
+                        t1 = self.read_reply(sent, timeout, read_timeout, max(command.count(b'?'), 1))
+                        result = t1 is not None
+                        stats.bytes_in += len(self.response)
+                    dt = time.perf_counter() - t0
+                    self.trace.record(wire, self.response, t0, dt, result, self.retries - n)
+                    if result:
+                        if check_response:
+                            dt = t1 - t0
+                        stats.record(command, dt, verb)
+                        break
+                    stats.timeout_count += 1
+                    stats.io_error_count += 1
                 dt = time.perf_counter() - t0
-                self.min_io_time = min(self.min_io_time, dt)
-                self.max_io_time = max(self.max_io_time, dt)
-                self.avg_io_time = (self.avg_io_time * (self.io_count - 1) + dt) / self.io_count
-                #
-                if result:
-                    break
-                self.io_error_count += 1
-            dt = time.perf_counter() - t0
-            if not result:
+                if not result:
+                    if self.bus is not None:
+                        # device state at the bus is unknown after error
+                        self.bus.address = None
+                    self.suspend()
+                    self.logger.info('%s I/O ERROR %s -> %s, %4.0f ms', self.pre, command, self.response, dt * 1000)
+                elif self.logger.isEnabledFor(logging.DEBUG):
+                    self.logger.debug('%s %s -> %s, %4.0f ms', self.pre, command, self.response, dt * 1000)
+                return result
+            except KeyboardInterrupt:
+                raise
+            except:
+                stats.io_error_count += 1
+                log_exception(self.logger, f'{self.pre} Command {command} exception')
                 self.suspend()
-                self.logger.info(f'{self.pre} I/O ERROR {command} -> {self.response}, {result}, %4.0f ms', dt * 1000)
-            else:
-                self.logger.debug(f'{self.pre} {command} -> {self.response}, {result}, %4.0f ms', dt * 1000)
-            return result
-        except KeyboardInterrupt:
-            raise
-        except:
-            self.io_error_count += 1
-            log_exception(self, f'{self.pre} Command {command} exception')
-            self.suspend()
-            return False
+                return False
+
+    def stats(self):
+        # I/O statistics as dict
+        return self.io_stats.to_dict()
+
+    def reset_stats(self):
+        self.io_stats.reset()
+
+    def dump_trace(self):
+        # recent transactions as text, the oldest first
+        return self.trace.dump()
+
+    @property
+    def io_count(self):
+        return self.io_stats.io_count
+
+    @property
+    def io_error_count(self):
+        return self.io_stats.io_error_count
+
+    @property
+    def avg_io_time(self):
+        return self.io_stats.latency.mean
+
+    @property
+    def min_io_time(self):
+        return self.io_stats.latency.min
+
+    @property
+    def max_io_time(self):
+        return self.io_stats.latency.max
 
     @property
     def timeout(self):
@@ -196,73 +483,205 @@ class IT6900:
 
     @property
     def ready(self):
-        if time.perf_counter() < self.suspend_to:
-            # self.logger.debug(f'{self.pre} Suspended')
-            return False
-        if self.suspend_to <= 0.0:
-            return True
-        # was suspended and expires
-        self.close_com_port()
-        val = self.init()
-        return val
+        # never blocks, recovery after suspend runs in background thread
+        return self.state == self.ONLINE
 
     @ready.setter
     def ready(self, value):
-        self._ready = bool(value)
         if value:
+            self.state = self.ONLINE
             self.suspend_to = 0.0
+            self.recovery_count = 0
+            self.ready_event.set()
+        else:
+            self.state = self.OFFLINE
+            self.ready_event.clear()
+
+    def wait_ready(self, timeout=None):
+        # wait for device to get online, returns ready
+        self.ready_event.wait(timeout)
+        return self.ready
 
     def read(self, size=1, timeout=None):
-        result = b''
+        # read up to size bytes, bytes beyond size stay in buffer for the next read
         if timeout is None:
             timeout = self.read_timeout
         self.timeout = timeout
         try:
-            while len(result) < size:
-                if self.com.in_waiting > 0:
-                    r = self.com.read(1)
-                    if len(r) > 0:
-                        result += r
-                if self.timeout:
-                    self.logger.debug(f'{self.pre} read timeout')
-                    return result
+            while len(self.buffer) < size:
+                if not self.fill_buffer():
+                    if self.timeout:
+                        if self.logger.isEnabledFor(logging.DEBUG):
+                            self.logger.debug('%s read timeout', self.pre)
+                        break
+                    time.sleep(self.poll_interval)
         except KeyboardInterrupt:
             raise
         except:
             log_exception(self.logger, f'{self.pre} read exception')
+        result = bytes(self.buffer[:size])
+        del self.buffer[:size]
         return result
 
+    def fill_buffer(self):
+        # move all bytes available at com port to the buffer
+        n = self.com.in_waiting
+        if n <= 0:
+            return False
+        r = self.com.read(n)
+        if not r:
+            return False
+        self.buffer += r
+        return True
+
     def suspend(self):
-        if time.perf_counter() < self.suspend_to:
+        # mark device offline and schedule recovery with exponential backoff
+        if self.state == self.OFFLINE and time.perf_counter() < self.suspend_to:
             return
-        self.suspend_to = time.perf_counter() + self.suspend_delay
-        self.logger.debug(f'{self.pre} Suspended for {self.suspend_delay} s')
+        delay = min(self.suspend_delay * 2 ** self.recovery_count, self.max_suspend_delay)
+        self.ready = False
+        self.suspend_to = time.perf_counter() + delay
+        self.logger.debug(f'{self.pre} Suspended for {delay} s')
+        self.start_recovery()
+
+    def start_recovery(self):
+        with self.recovery_lock:
+            if self.closed or (self.recovery_thread is not None and self.recovery_thread.is_alive()):
+                return
+            self.recovery_thread = Thread(target=self.recover, name=f'IT6900 recovery {self.port}', daemon=True)
+            self.recovery_thread.start()
+
+    def recover(self):
+        # recovery state machine: OFFLINE -> PROBING -> ONLINE or OFFLINE with longer delay
+        while not self.closed and self.state != self.ONLINE:
+            delay = self.suspend_to - time.perf_counter()
+            if delay > 0.0:
+                self.recovery_event.wait(delay)
+                self.recovery_event.clear()
+                continue
+            try:
+                with self.lock:
+                    if self.closed or self.state == self.ONLINE:
+                        break
+                    self.close_com_port()
+                    self.state = self.PROBING
+                    self.recovery_count += 1
+                    self.logger.debug(f'{self.pre} Recovery attempt {self.recovery_count}')
+                    self.com = self.create_com_port()
+                    if not self.init() and self.state != self.OFFLINE:
+                        self.suspend()
+            except KeyboardInterrupt:
+                raise
+            except:
+                log_exception(self.logger, f'{self.pre} Recovery exception')
+                self.ready = False
+                self.suspend_to = 0.0
+                self.suspend()
+        with self.recovery_lock:
+            self.recovery_thread = None
+        # suspend may have been called just before the thread finished
+        if not self.closed and self.state == self.OFFLINE:
+            self.start_recovery()
+
+    def close(self):
+        # close device for good, no recovery after it
+        self.closed = True
+        self.recovery_event.set()
+        self.abort_ramp(1.0)
+        with self.lock:
+            self.close_com_port()
+        IT6900Registry.unregister(self)
 
     def read_until(self, terminator=LF, size=None, timeout=None):
-        result = b''
-        r = b''
-        while terminator not in r:
-            r = self.read(1, timeout=timeout)
-            if len(r) <= 0:
-                return result
-            result += r
-            if size is not None and len(result) >= size:
-                return result
+        # read up to and including terminator, bytes after terminator stay in buffer
+        if timeout is None:
+            timeout = self.read_timeout
+        self.timeout = timeout
+        start = 0
+        try:
+            while True:
+                i = self.buffer.find(terminator, start)
+                if i >= 0:
+                    n = i + len(terminator)
+                    break
+                if size is not None and len(self.buffer) >= size:
+                    n = size
+                    break
+                start = max(0, len(self.buffer) - len(terminator) + 1)
+                if not self.fill_buffer():
+                    if self.timeout:
+                        if self.logger.isEnabledFor(logging.DEBUG):
+                            self.logger.debug('%s read timeout', self.pre)
+                        n = len(self.buffer)
+                        break
+                    time.sleep(self.poll_interval)
+        except KeyboardInterrupt:
+            raise
+        except:
+            log_exception(self.logger, f'{self.pre} read exception')
+            n = len(self.buffer)
+        if size is not None:
+            n = min(n, size)
+        result = bytes(self.buffer[:n])
+        del self.buffer[:n]
         return result
 
-    def read_response(self, expected=LF):
-        result = self.read_until(expected)
+    def read_response(self, expected=LF, timeout=None):
+        result = self.read_until(expected, timeout=timeout)
         self.response = result
         if expected not in result:
-            self.logger.debug(f'{self.pre} Response %s without %s ', result, expected)
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug('%s Response %s without %s', self.pre, result, expected)
             return False
         return True
 
-    def write(self, cmd):
+    def read_reply(self, sent, timeout, read_timeout, fields):
+        # read reply to the last of sent attempts, device replies in order
+        # sent (list) - (send time, number of RETRY_QUERY tags) of attempts without reply
+        # timeout (float) - wait after the last send, s
+        # fields (int) - number of ';' separated values in reply without tags
+        # returns time when accepted reply was received or None, reply without tags is in self.response
+        tags = sent[-1][1]
+        reply = None
+        t1 = None
+        while True:
+            now = time.perf_counter()
+            # earlier attempt without reply in read_timeout is lost
+            while len(sent) > 1 and now >= sent[0][0] + read_timeout:
+                sent.pop(0)
+            line = self.read_until(LF, timeout=sent[-1][0] + timeout - now)
+            if not line.endswith(LF):
+                # incomplete line stays for the next read
+                self.buffer[0:0] = line
+                break
+            t1 = time.perf_counter()
+            n = line.count(b';') + 1 - fields
+            if tags > 0 and n > 0:
+                line = line.rsplit(b';', n)[0].rstrip(LF) + LF
+            reply = line
+            if n >= tags or len(sent) <= 1:
+                sent.clear()
+                break
+            # late reply of an earlier attempt, it is kept if reply of the last one is lost
+            self.io_stats.late_count += 1
+            while len(sent) > 1 and sent[0][1] <= n:
+                sent.pop(0)
+        if reply is None:
+            self.response = bytes(self.buffer)
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug('%s Response %s without %s', self.pre, self.response, LF)
+            return None
+        self.response = reply
+        return t1
+
+    def write(self, cmd, reset=True):
+        # reset (bool) - discard received input, False keeps replies of earlier attempts for counting
         # t0 = time.perf_counter()
         try:
             # reset buffers
-            self.com.reset_input_buffer()
+            if reset:
+                self.buffer.clear()
+                self.com.reset_input_buffer()
             self.com.reset_output_buffer()
             # write command
             length = self.com.write(cmd)
@@ -278,34 +697,186 @@ class IT6900:
             log_exception(self.logger, f'{self.pre} Exception during write')
             return False
 
+    def exchange(self, cmd, check_ready=True):
+        # send_command and its response taken under one lock, device is shared by threads
+        # returns response or None on error
+        # offline device does not wait for the lock held by recovery
+        if check_ready and not self.ready:
+            return None
+        with self.lock:
+            if not self.send_command(cmd, check_ready=check_ready):
+                return None
+            return self.response
+
+    def query(self, cmd: Command):
+        # send precompiled command and parse response, returns None on error
+        response = self.exchange(cmd)
+        if response is None:
+            return None
+        try:
+            return cmd.parser(response)
+        except ValueError:
+            self.io_stats.parse_error_count += 1
+            self.logger.info('%s Malformed response %s for %s', self.pre, response, cmd.wire)
+            return None
+
     def read_value(self, cmd, v_type=float):
+        if cmd.__class__ is Command:
+            return self.query(cmd)
+        response = self.exchange(cmd)
         try:
-            if self.send_command(cmd):
-                return v_type(self.response)
+            if response is not None:
+                return v_type(response)
             else:
                 return None
         except KeyboardInterrupt:
             raise
         except:
-            self.logger.debug('Can not convert %s to %s', self.response, v_type)
+            self.logger.debug('Can not convert %s to %s', response, v_type)
             return None
 
+    def convert_value(self, value: bytes, v_type=float):
+        # convert single response to v_type, returns None if not possible
+        return convert_value(value, v_type, self.logger)
+
+    def query_many(self, commands, v_types=None):
+        # send several queries in one line chained by ';'
+        # commands (list of Command, bytes or str) - queries
+        # v_types (list of types or None) - result types for not precompiled commands, float by default
+        # returns list of values, None for failed items
+        commands = tuple(commands)
+        if commands and all(c.__class__ is Command for c in commands):
+            return self.query_chain(commands)
+        commands = [c.encode() if isinstance(c, str) else c for c in commands]
+        commands = [c.upper().strip() for c in commands]
+        if v_types is None:
+            v_types = [float] * len(commands)
+        v_types = list(v_types)
+        if len(commands) <= 0:
+            return []
+        values = [None] * len(commands)
+        with self.lock:
+            if len(commands) > 1 and self.send_command(b';'.join(commands), True):
+                parts = self.response[:-1].split(b';')
+                if len(parts) == len(commands):
+                    values = [self.convert_value(r, t) for r, t in zip(parts, v_types)]
+                else:
+                    self.logger.debug('%s Wrong response %s for %s', self.pre, self.response, commands)
+            # fall back to separate queries for missing values
+            for i in range(len(commands)):
+                if values[i] is None and self.send_command(commands[i], True):
+                    values[i] = self.convert_value(self.response, v_types[i])
+        return values
+
+    # chained commands by tuple of commands, built once
+    _chains = {}
+
+    def query_chain(self, commands):
+        # query_many for precompiled commands
+        c = IT6900._chains.get(commands)
+        if c is None:
+            c = chain(commands)
+            IT6900._chains[commands] = c
+        values = [None] * len(commands)
+        with self.lock:
+            if len(commands) > 1 and self.send_command(c):
+                parts = self.response.split(b';')
+                if len(parts) == len(commands):
+                    for i, part in enumerate(parts):
+                        try:
+                            values[i] = commands[i].parser(part)
+                        except ValueError:
+                            self.io_stats.parse_error_count += 1
+                else:
+                    self.io_stats.parse_error_count += 1
+                    self.logger.info('%s Malformed response %s for %s', self.pre, self.response, c.wire)
+            # fall back to separate queries for missing values
+            for i in range(len(commands)):
+                if values[i] is None:
+                    values[i] = self.query(commands[i])
+        return values
+
+    def read_all(self):
+        # read all measured and programmed values in one transaction
+        # returns dict, None for values not read
+        values = self.query_chain(self.STATUS_COMMANDS)
+        return dict(zip(self.STATUS_QUERIES.keys(), values))
+
     def write_value(self, cmd, value):
         if isinstance(cmd, str):
             cmd = cmd.encode()
         cmd1 = cmd.upper().strip()
-        cmd2 = cmd1 + b' ' + str(value).encode() + b';' + cmd1 + b'?'
-        v = self.read_value(cmd2, type(value))
+        template = self.SET_COMMANDS.get(cmd1)
+        if template is not None and isinstance(value, float):
+            v = self.query(template.bind(value))
+        else:
+            cmd2 = cmd1 + b' ' + str(value).encode() + b';' + cmd1 + b'?'
+            v = self.read_value(cmd2, type(value))
+        self.invalidate_setpoints(cmd1)
+        if isinstance(value, float) and v is not None:
+            return abs(v - value) <= self.setpoint_tolerance
         return value == v
 
+    def invalidate_setpoints(self, cmd: bytes = None):
+        # setpoint was written bypassing coalescing writer, its cached value is not valid any more
+        # cmd (bytes) - b'VOLT' or b'CURR', None - all writers
+        for key, writer in list(self.setpoint_writers.items()):
+            if cmd is None or key == cmd:
+                writer.invalidate()
+
+    def setpoint_writer(self, cmd: bytes):
+        writer = self.setpoint_writers.get(cmd)
+        if writer is None:
+            writer = SetpointWriter(self, cmd, tolerance=self.setpoint_tolerance,
+                                    verify_every=self.kwargs.get('verify_every', 0))
+            self.setpoint_writers[cmd] = writer
+        return writer
+
+    def set_voltage(self, value: float):
+        # coalesced write without waiting for verification
+        # returns False if the previous write or verification failed
+        writer = self.setpoint_writer(b'VOLT')
+        return writer.set(value) and not writer.error
+
+    def set_current(self, value: float):
+        # coalesced write without waiting for verification
+        # returns False if the previous write or verification failed
+        writer = self.setpoint_writer(b'CURR')
+        return writer.set(value) and not writer.error
+
+    def ramp(self, target: float, rate: float, step: float, command=b'VOLT'):
+        # ramp setpoint (b'VOLT' or b'CURR') to target with rate units/s by steps
+        # runs in background, returns Ramp or None if ramp can not be started
+        self.abort_ramp()
+        limit = self.max_voltage if command == b'VOLT' else self.max_current
+        if not 0.0 <= target <= limit:
+            self.logger.warning('%s Ramp target %s out of range', self.pre, target)
+            return None
+        start = self.read_value(self.READ_COMMANDS.get(command, command + b'?'))
+        if start is None:
+            return None
+        self.ramp_task = Ramp(self, command, target, rate, step)
+        # ramp steps bypass the coalescing writer
+        self.invalidate_setpoints(command)
+        self.ramp_task.start(start)
+        return self.ramp_task
+
+    def abort_ramp(self, timeout=None):
+        if self.ramp_task is not None and self.ramp_task.running():
+            self.ramp_task.abort()
+            self.ramp_task.wait(timeout)
+            # setpoint is left somewhere between start and target
+            self.invalidate_setpoints(self.ramp_task.command)
+
+    @property
+    def ramp_state(self):
+        if self.ramp_task is None:
+            return Ramp.IDLE
+        return self.ramp_task.state
+
     def write_output(self, value: bool):
-        if value:
-            t_value = b'ON'
-        else:
-            t_value = b'OFF'
-        cmd = b'OUTP ' + t_value
-        v = self.read_value(cmd, bool)
-        return True
+        # no response for OUTP, returns result of sending
+        return self.send_command(COMMANDS['output_on'] if value else COMMANDS['output_off'])
 
     def write_voltage(self, value: float):
         return self.write_value(b'VOLT', value)
@@ -314,35 +885,28 @@ class IT6900:
         return self.write_value(b'CURR', value)
 
     def read_output(self):
-        if not self.send_command(b'OUTP?'):
-            return None
-        response = self.response.upper()
-        if response.startswith((b'ON', b'1')):
-            return True
-        if response.startswith((b'OFF', b'0')):
-            return False
-        self.logger.info('Unexpected response %s' % response)
-        return None
+        return self.query(COMMANDS['output'])
 
     def read_current(self):
-        return self.read_value(b'MEAS:CURR?')
+        return self.query(COMMANDS['current'])
 
     def read_programmed_current(self):
-        return self.read_value(b'CURR?')
+        return self.query(COMMANDS['programmed_current'])
 
     def read_voltage(self):
-        return self.read_value(b'MEAS:VOLT?')
+        return self.query(COMMANDS['voltage'])
 
     def read_programmed_voltage(self):
-        return self.read_value(b'VOLT?')
+        return self.query(COMMANDS['programmed_voltage'])
 
     def read_power(self):
-        return self.read_value(b'MEAS:POW?')
+        return self.query(COMMANDS['power'])
 
     def read_device_id(self, check_ready=True):
         try:
-            if self.send_command(b'*IDN?', check_ready=check_ready):
-                return self.response[:-1].decode()
+            response = self.exchange(COMMANDS['idn'], check_ready)
+            if response is not None:
+                return response[:-1].decode()
             else:
                 return 'Unknown Device'
         except KeyboardInterrupt:
@@ -350,43 +914,40 @@ class IT6900:
         except:
             return 'Unknown Device'
 
+    @staticmethod
+    def parse_device_id(id):
+        # returns (type, serial number) from *IDN? response
+        items = id.split(',')
+        device_type = items[1].strip() if len(items) > 1 else 'Unknown Device'
+        serial_number = items[2].strip() if len(items) > 2 else ''
+        return device_type, serial_number
+
     def read_serial_number(self):
-        try:
-            if self.send_command(b'*IDN?'):
-                serial_number = self.response[:-1].decode().split(',')[2]
-                return serial_number
-            else:
-                return ""
-        except KeyboardInterrupt:
-            raise
-        except:
+        id = self.read_device_id()
+        if not self.id_ok(id):
             return ""
+        return self.parse_device_id(id)[1]
 
     def read_device_type(self):
-        try:
-            if self.send_command(b'*IDN?'):
-                return self.response[:-1].decode().split(',')[1]
-            else:
-                return "Unknown Device"
-        except KeyboardInterrupt:
-            raise
-        except:
+        id = self.read_device_id()
+        if not self.id_ok(id):
             return "Unknown Device"
+        return self.parse_device_id(id)[0]
 
     def read_errors(self):
-        if self.send_command(b'SYST:ERR?'):
-            return self.response[:-1].decode()
-        else:
+        v = self.query(COMMANDS['errors'])
+        if v is None:
             return ''
+        return v
 
     def switch_local(self):
-        return self.send_command(b'SYST:LOC', False, False)
+        return self.send_command(COMMANDS['local'], False, False)
 
     def clear_status(self):
-        return self.send_command(b'*CLS', False, False)
+        return self.send_command(COMMANDS['clear_status'], False, False)
 
     def switch_remote(self):
-        return self.send_command(b'SYST:REM', False, False)
+        return self.send_command(COMMANDS['remote'], False, False)
 
     def reconnect(self, port=None, *args, **kwargs):
         if time.perf_counter() < self.reconnect_timeout_time:
@@ -397,27 +958,60 @@ class IT6900:
             self.args = args
         if len(kwargs) > 0:
             self.kwargs = kwargs
-        self.ready = False
-        self.close_com_port()
-        self.com = self.create_com_port()
-        self.init()
+        # port is shared with recovery, acquisition, stream, writers and ramps
+        with self.lock:
+            self.ready = False
+            self.close_com_port()
+            self.com = self.create_com_port()
+            self.init()
 
     def initialized(self):
         return self.ready
 
-    def detect_baud(self):
+    def detect_baud(self, bauds=None, timeout=0.1):
+        # find baud rate by short *IDN? probes, returns found baud rate or None
         if self.ready:
-            return
-        bauds = (115200, 9600, 4800, 19200, 38400, 57600)
-        #bauds = (115200,)
-        for baud in bauds:
-            self.logger.debug('Try reconnect at %s', baud)
-            self.kwargs['baudrate'] = baud
-            time.sleep(2.0)
-            self.reconnect()
-            if self.ready:
-                self.logger.debug('Reconnected successfully at %s', baud)
-                return
+            return self.kwargs.get('baudrate')
+        if bauds is None:
+            bauds = self.BAUDS
+        # try last good baud rate for the port first
+        last = self.get_id_cache(f'{self.port}:baudrate')
+        if last in bauds:
+            bauds = (last,) + tuple(b for b in bauds if b != last)
+        # configured rate is restored if device is not found, e.g. it is powered off
+        baudrate = self.kwargs.get('baudrate')
+        with self.lock:
+            for baud in bauds:
+                self.logger.debug('%s Probe at %s', self.pre, baud)
+                self.kwargs['baudrate'] = baud
+                self.close_com_port()
+                self.com = self.create_com_port()
+                if self.probe(timeout):
+                    self.logger.debug('%s Device found at %s', self.pre, baud)
+                    if baud != last:
+                        self.put_id_cache(f'{self.port}:baudrate', baud)
+                    self.init()
+                    return baud
+            self.logger.info('%s Baud rate detection failed', self.pre)
+            if baudrate is None:
+                self.kwargs.pop('baudrate', None)
+            else:
+                self.kwargs['baudrate'] = baudrate
+        # recovery reopens port at the configured rate
+        self.suspend()
+        return None
+
+    def probe(self, timeout=0.1):
+        # one *IDN? without retries, statistics and suspend
+        try:
+            if not self.write(b'*IDN?' + LF):
+                return False
+            response = self.read_until(LF, timeout=timeout)
+            return self.id_ok(response.decode(errors='replace'))
+        except KeyboardInterrupt:
+            raise
+        except:
+            return False
 
     def id_ok(self, id=None):
         if id is None:
@@ -425,6 +1019,18 @@ class IT6900:
         return id.startswith(self.ID_OK)
 
 
+def detect_baud_all(devices, bauds=None, timeout=0.1):
+    # detect baud rates of devices at different ports in parallel
+    # returns dict {port: baud rate or None}
+    devices = [d for d in devices if not d.ready]
+    if not devices:
+        return {}
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=len(devices)) as executor:
+        results = executor.map(lambda d: d.detect_baud(bauds, timeout), devices)
+        return dict(zip((d.port for d in devices), results))
+
+
 class IT6900_Lambda(IT6900):
     ID_OK = 'TDK-LAMBDA'
     DEVICE_NAME = 'TDK-LAMBDA Genesys+'
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""Background acquisition of IT6900 measured and programmed values"""
+import time
+from threading import Thread, Event
+
+from log_exception import log_exception
+
+
+class IT6900Acquisition:
+    def __init__(self, device, period: float = 0.5, **kwargs):
+        # device (IT6900) - power supply to poll
+        # period (float) - polling period, s
+        self.device = device
+        self.period = period
+        self.logger = kwargs.get('logger', device.logger)
+        # last snapshot: dict of values read by device.read_all() plus 'time' key
+        self.snapshot = {'time': 0.0}
+        # functions called as callback(snapshot) after each refresh
+        self.callbacks = list(kwargs.get('callbacks', ()))
+        self.cycle_count = 0
+        self.stop_event = Event()
+        self.thread = None
+
+    def start(self):
+        if self.running():
+            return
+        self.stop_event.clear()
+        self.thread = Thread(target=self.run, name=f'IT6900 acquisition {self.device.port}', daemon=True)
+        self.thread.start()
+        self.logger.debug('%s Acquisition started with period %s s', self.device.pre, self.period)
+
+    def stop(self, timeout=None):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+        self.thread = None
+
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def run(self):
+        while not self.stop_event.is_set():
+            t0 = time.perf_counter()
+            try:
+                self.refresh()
+            except KeyboardInterrupt:
+                raise
+            except:
+                log_exception(self.logger, f'{self.device.pre} Acquisition exception')
+            dt = time.perf_counter() - t0
+            self.stop_event.wait(max(self.period - dt, 0.0))
+
+    def refresh(self):
+        if self.device.initialized():
+            snapshot = self.device.read_all()
+        else:
+            snapshot = {}
+        snapshot['time'] = time.time()
+        # replace the whole dict, so readers always see a consistent snapshot
+        self.snapshot = snapshot
+        self.cycle_count += 1
+        for callback in self.callbacks:
+            try:
+                callback(snapshot)
+            except KeyboardInterrupt:
+                raise
+            except:
+                log_exception(self.logger, f'{self.device.pre} Acquisition callback exception')
+        return snapshot
+
+    def get(self, name, max_age=None):
+        # returns cached value or None if absent or older than max_age seconds
+        snapshot = self.snapshot
+        if max_age is not None and time.time() - snapshot['time'] > max_age:
+            return None
+        return snapshot.get(name)
+
+    def invalidate(self, name=None):
+        # drop cached value(s), e.g. after write to the device
+        snapshot = dict(self.snapshot)
+        if name is None:
+            snapshot = {'time': snapshot['time']}
+        else:
+            snapshot.pop(name, None)
+        self.snapshot = snapshot
+
+
+class IT6900GroupAcquisition(IT6900Acquisition):
+    # one thread refreshes acquisitions of several devices, e.g. sharing one port
+    def __init__(self, acquisitions, period: float = 1.0, **kwargs):
+        super().__init__(acquisitions[0].device, period, **kwargs)
+        self.acquisitions = list(acquisitions)
+
+    def refresh(self):
+        for acquisition in self.acquisitions:
+            if self.stop_event.is_set():
+                break
+            try:
+                acquisition.refresh()
+            except KeyboardInterrupt:
+                raise
+            except:
+                log_exception(self.logger, f'{acquisition.device.pre} Acquisition exception')
+        self.cycle_count += 1
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""IT6900 driver benchmark against emulated devices"""
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import time
+from threading import Thread
+
+import IT6900
+from EmultedIT6900AtComPort import EmultedIT6900AtComPort
+from IT6900_Commands import COMMANDS
+from IT6900_Stats import LatencyHistogram
+
+from config_logger import config_logger
+
+# operations for benchmark command mix, name: function(device) returning None on failure
+OPERATIONS = {
+    'voltage': lambda d: d.read_voltage(),
+    'current': lambda d: d.read_current(),
+    'power': lambda d: d.read_power(),
+    'output': lambda d: d.read_output(),
+    'programmed_voltage': lambda d: d.read_programmed_voltage(),
+    'write_voltage': lambda d: d.write_voltage(1.0) or None,
+    # read_device_id returns 'Unknown Device' on failure
+    'idn': lambda d: d.query(COMMANDS['idn']),
+    'read_all': lambda d: d.read_all(),
+}
+
+
+def emulator(port, *args, **kwargs):
+    # transport connected directly to emulator, without ComPort
+    com = EmultedIT6900AtComPort(port, *args, **kwargs)
+    delay = kwargs.get('response_delay')
+    if delay is not None:
+        com.RESPONSE_DELAY = delay
+    return com
+
+
+class EmulatedIT6900(IT6900.IT6900):
+    def __init__(self, port: str, *args, **kwargs):
+        kwargs.setdefault('transport', emulator)
+        super().__init__(port, *args, **kwargs)
+
+
+def parse_mix(text):
+    # 'voltage:3,output:1' -> ['voltage', 'voltage', 'voltage', 'output']
+    mix = []
+    for item in text.split(','):
+        name, _, weight = item.strip().partition(':')
+        if name not in OPERATIONS:
+            raise ValueError(f'Unknown operation {name}, use one of {", ".join(OPERATIONS)}')
+        mix += [name] * int(weight or 1)
+    return mix
+
+
+def create_devices(count, bus=False, **kwargs):
+    # emulated ports need no OS lock
+    kwargs.setdefault('port_lock', False)
+    # traffic of each port to its own file
+    record = kwargs.pop('record', None)
+    replay = kwargs.pop('replay', None)
+    if replay:
+        if bus:
+            return [IT6900.IT6900(f'replay://{replay}', address=i + 1, replay_loop=True, **kwargs)
+                    for i in range(count)]
+        return [IT6900.IT6900(f'replay://{replay}' + (f'.{i}' if count > 1 else ''), replay_loop=True, **kwargs)
+                for i in range(count)]
+    if record and count > 1 and not bus:
+        return [EmulatedIT6900(f'BENCH{i}', record=f'{record}.{i}', **kwargs) for i in range(count)]
+    kwargs['record'] = record
+    if bus:
+        return [EmulatedIT6900('BENCH', address=i + 1, **kwargs) for i in range(count)]
+    return [EmulatedIT6900(f'BENCH{i}', **kwargs) for i in range(count)]
+
+
+def run(devices, mix, duration=5.0, threads=True):
+    # returns dict of results
+    end_time = time.perf_counter() + duration
+    # histograms of every worker thread: {operation: histogram} for successful operations and failures,
+    # merged after all threads are finished
+    results = []
+
+    def worker(device_list):
+        histograms = {name: LatencyHistogram() for name in set(mix)}
+        failures = LatencyHistogram()
+        results.append((histograms, failures))
+        i = 0
+        while time.perf_counter() < end_time:
+            for device in device_list:
+                name = mix[i % len(mix)]
+                t0 = time.perf_counter()
+                value = OPERATIONS[name](device)
+                dt = time.perf_counter() - t0
+                if value is None:
+                    failures.record(dt)
+                else:
+                    histograms[name].record(dt)
+            i += 1
+
+    for d in devices:
+        d.reset_stats()
+    cpu0 = time.process_time()
+    t0 = time.perf_counter()
+    if threads:
+        workers = [Thread(target=worker, args=([d],)) for d in devices]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+    else:
+        worker(devices)
+    elapsed = time.perf_counter() - t0
+    cpu = time.process_time() - cpu0
+    histograms = {name: LatencyHistogram() for name in set(mix)}
+    failures = LatencyHistogram()
+    for h, f in results:
+        for name in h:
+            histograms[name].merge(h[name])
+        failures.merge(f)
+    total = LatencyHistogram()
+    for h in histograms.values():
+        total.merge(h)
+    # completed transactions with the device, calls rejected at once for offline device are not counted
+    queries = sum(d.io_stats.latency.count for d in devices)
+    return {'elapsed': elapsed,
+            'operations': total.count + failures.count,
+            'failed': failures.count,
+            'operations_per_s': total.count / elapsed,
+            'queries': queries,
+            'queries_per_s': queries / elapsed,
+            'cpu_s': cpu,
+            'cpu_s_per_query': cpu / queries if queries else 0.0,
+            'latency': total.to_dict(),
+            'failure_latency': failures.to_dict(),
+            'operation_latency': {k: v.to_dict() for k, v in histograms.items()},
+            'io': [d.stats() for d in devices]}
+
+
+def cold_start(**kwargs):
+    # import time of driver module in fresh interpreter and time to get one device online
+    code = 'import time; t0 = time.perf_counter(); import IT6900; print(time.perf_counter() - t0)'
+    out = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True)
+    result = {'import_s': float(out.stdout.strip() or 'nan')}
+    for name, background in (('blocking', False), ('background', True)):
+        t0 = time.perf_counter()
+        device = EmulatedIT6900('COLD', background_init=background, port_lock=False, **kwargs)
+        t1 = time.perf_counter()
+        device.wait_ready(5.0)
+        t2 = time.perf_counter()
+        result[name] = {'constructor_s': t1 - t0, 'ready_s': t2 - t0, 'ready': device.ready}
+        device.close()
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='IT6900 driver benchmark against emulated devices')
+    parser.add_argument('-n', '--devices', type=int, default=1, help='number of emulated devices')
+    parser.add_argument('-d', '--duration', type=float, default=5.0, help='test duration, s')
+    parser.add_argument('-m', '--mix', default='voltage:2,current:2,output:1',
+                        help='command mix, name:weight,... names: ' + ', '.join(OPERATIONS))
+    parser.add_argument('--response-delay', type=float, default=EmultedIT6900AtComPort.RESPONSE_DELAY,
+                        help='emulated device response delay, s')
+    parser.add_argument('--realistic', action='store_true',
+                        help='emulate serial timing from baud rate and per command delays')
+    parser.add_argument('--baudrate', type=int, default=115200, help='baud rate for realistic mode')
+    parser.add_argument('--jitter', type=float, default=0.0, help='max random response delay, s')
+    parser.add_argument('--drop-rate', type=float, default=0.0, help='probability to lose response')
+    parser.add_argument('--seed', type=int, default=None, help='random seed for jitter and drops')
+    parser.add_argument('--bus', action='store_true', help='all devices at one shared port with addresses')
+    parser.add_argument('--sequential', action='store_true', help='poll devices from one thread')
+    parser.add_argument('--record', default=None, help='record port traffic to file (file.N for several ports)')
+    parser.add_argument('--replay', default=None, help='replay recorded traffic instead of emulator')
+    parser.add_argument('--cold-start', action='store_true', help='measure import and device startup times only')
+    parser.add_argument('-o', '--output', default=None, help='JSON file to write results')
+    args = parser.parse_args(argv)
+
+    logger = config_logger()
+    logger.setLevel('WARNING')
+    if args.cold_start:
+        results = cold_start(logger=logger, response_delay=args.response_delay)
+        print(f"import: {results['import_s'] * 1000.0:.1f} ms")
+        for name in ('blocking', 'background'):
+            r = results[name]
+            print(f"{name} init: constructor {r['constructor_s'] * 1000.0:.1f} ms, "
+                  f"ready {r['ready_s'] * 1000.0:.1f} ms")
+        report = {'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+                  'python': sys.version.split()[0],
+                  'platform': platform.platform(),
+                  'parameters': vars(args),
+                  'cold_start': results}
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(report, f, indent=1)
+        return report
+    devices = create_devices(args.devices, args.bus, logger=logger, response_delay=args.response_delay,
+                             realistic=args.realistic, baudrate=args.baudrate, jitter=args.jitter,
+                             drop_rate=args.drop_rate, seed=args.seed, record=args.record, replay=args.replay)
+    results = run(devices, parse_mix(args.mix), args.duration, not args.sequential)
+    for d in devices:
+        d.close()
+    report = {'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+              'python': sys.version.split()[0],
+              'platform': platform.platform(),
+              'parameters': vars(args),
+              'results': results}
+    lat = results['latency']
+    print(f"devices: {args.devices}, mix: {args.mix}, response delay: {args.response_delay * 1000.0:.1f} ms")
+    print(f"operations: {results['operations']} ({results['failed']} failed), "
+          f"{results['operations_per_s']:.1f} successful op/s")
+    print(f"queries: {results['queries']}, {results['queries_per_s']:.1f} q/s")
+    print(f"latency ms: p50 {lat['p50'] * 1000:.2f}, p90 {lat['p90'] * 1000:.2f}, "
+          f"p99 {lat['p99'] * 1000:.2f}, max {lat['max'] * 1000:.2f}")
+    print(f"cpu: {results['cpu_s']:.3f} s, {results['cpu_s_per_query'] * 1e6:.1f} us per query")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+    return report
+
+
+if __name__ == "__main__":
+    main()
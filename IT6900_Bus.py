@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""Shared RS-485 bus for several IT6900 units at one COM port"""
+from collections import deque
+from threading import Condition, Lock, get_ident
+
+from config_logger import config_logger
+from log_exception import log_exception
+
+
+class FairRLock:
+    # reentrant lock granted to waiting threads in request order
+    def __init__(self):
+        self._condition = Condition(Lock())
+        self._owner = None
+        self._count = 0
+        self._queue = deque()
+
+    def acquire(self, blocking=True, timeout=-1):
+        me = get_ident()
+        with self._condition:
+            if self._owner == me:
+                self._count += 1
+                return True
+            if self._owner is None and not self._queue:
+                self._owner = me
+                self._count = 1
+                return True
+            if not blocking:
+                return False
+            self._queue.append(me)
+            if timeout is None or timeout < 0:
+                timeout = None
+            if not self._condition.wait_for(lambda: self._owner is None and self._queue[0] == me, timeout):
+                self._queue.remove(me)
+                self._condition.notify_all()
+                return False
+            self._queue.popleft()
+            self._owner = me
+            self._count = 1
+            return True
+
+    def release(self):
+        with self._condition:
+            if self._owner != get_ident():
+                raise RuntimeError('Release of not owned lock')
+            self._count -= 1
+            if self._count <= 0:
+                self._owner = None
+                self._count = 0
+                self._condition.notify_all()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
+class IT6900Bus:
+    _buses = {}
+    _buses_lock = Lock()
+
+    def __init__(self, port: str, **kwargs):
+        self.port = port
+        self.logger = kwargs.get('logger', config_logger())
+        # all transactions at the bus are serialized by this lock
+        self.lock = FairRLock()
+        self.com = None
+        # device holding OS lock of the port
+        self.owner = None
+        # currently selected address, None if unknown
+        self.address = None
+        # attached devices by address
+        self.devices = {}
+        self.switch_count = 0
+
+    @classmethod
+    def get(cls, port: str, **kwargs):
+        # returns existing bus for port or creates new one
+        port = port.strip()
+        with cls._buses_lock:
+            bus = cls._buses.get(port)
+            if bus is None:
+                bus = cls(port, **kwargs)
+                cls._buses[port] = bus
+            return bus
+
+    def attach(self, device):
+        # add device to the bus, opens com port by the first device
+        with self.lock:
+            if device.address in self.devices and self.devices[device.address] is not device:
+                self.logger.warning('%s Address %s is already in use at %s', device.pre, device.address, self.port)
+            self.devices[device.address] = device
+            if self.com is None:
+                # port lock is held by the device which opened the port
+                if not device.lock_port():
+                    return None
+                self.owner = device
+                self.com = device.open_com_port()
+                self.address = None
+            return self.com
+
+    def detach(self, device):
+        # remove device from the bus, closes com port after the last device
+        with self.lock:
+            if self.devices.get(device.address) is device:
+                del self.devices[device.address]
+            if self.devices or self.com is None:
+                return
+            try:
+                self.com.close()
+            except KeyboardInterrupt:
+                raise
+            except:
+                log_exception(self.logger, f'{self.port} COM port close exception')
+            self.com = None
+            self.address = None
+            if self.owner is not None:
+                self.owner.unlock_port()
+                self.owner = None
+
+    def select(self, device):
+        # switch bus to device address, does nothing if it is already selected
+        with self.lock:
+            if self.address == device.address:
+                return True
+            cmd = device.ADDRESS_COMMAND + b' %d' % device.address + b'\n'
+            self.address = None
+            try:
+                self.com.reset_input_buffer()
+                if self.com.write(cmd) != len(cmd):
+                    self.logger.error('%s Address switch error at %s', device.pre, self.port)
+                    return False
+            except KeyboardInterrupt:
+                raise
+            except:
+                log_exception(self.logger, f'{device.pre} Address switch exception')
+                return False
+            self.address = device.address
+            self.switch_count += 1
+            return True
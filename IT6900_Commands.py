@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""Precompiled IT6900 SCPI commands with response parsers"""
+from collections import namedtuple
+
+from IT6900_Stats import IOStats
+
+LF = b'\n'
+# latency classes, slow commands get longer read timeout until their latency is learned
+FAST = 'fast'
+SLOW = 'slow'
+
+
+# parsers get response without or with LF, send_command has already checked that LF is received
+def parse_float(response: bytes):
+    # b'1.5\n' -> 1.5, raises ValueError for empty, chained or garbage response
+    return float(response)
+
+
+def parse_bool(response: bytes):
+    # b'ON\n', b'1\n' -> True, b'OFF\n', b'0\n' -> False
+    value = response.strip().upper()
+    if value in (b'ON', b'1'):
+        return True
+    if value in (b'OFF', b'0'):
+        return False
+    raise ValueError('Not a boolean')
+
+
+def parse_text(response: bytes):
+    return response.rstrip(b'\r\n').decode()
+
+
+class Command(namedtuple('Command', 'wire query parser latency verb')):
+    # wire (bytes) - command as sent, upper case with LF
+    # query (bool) - response is expected
+    # parser (function or None) - converts response bytes to value, raises ValueError
+    # latency (str) - FAST or SLOW
+    # verb (str) - key of latency statistics
+    __slots__ = ()
+
+    def bind(self, value):
+        # command with value substituted for %s, e.g. b'VOLT %s;VOLT?'
+        return self._replace(wire=self.wire % str(value).encode())
+
+
+def command(text, parser=None, latency=FAST):
+    # build command once, at import
+    if isinstance(text, str):
+        text = text.encode()
+    # value placeholder %s stays lower case
+    text = text.upper().strip().replace(b'%S', b'%s')
+    wire = text + LF
+    # own latency profile for every command, 'VOLT? MAX' is not 'VOLT?'
+    verb = IOStats.verb(text)
+    return Command(wire, b'?' in wire, parser, latency, verb)
+
+
+def chain(commands):
+    # several queries in one line chained by ';'
+    wire = b';'.join(c.wire[:-1] for c in commands) + LF
+    return Command(wire, True, None, max((c.latency for c in commands), key=(FAST, SLOW).index),
+                   ';'.join(c.verb for c in commands))
+
+
+COMMANDS = {
+    'idn': command(b'*IDN?', parse_text, SLOW),
+    'remote': command(b'SYST:REM'),
+    'local': command(b'SYST:LOC'),
+    'clear_status': command(b'*CLS'),
+    'errors': command(b'SYST:ERR?', parse_text),
+    'voltage': command(b'MEAS:VOLT?', parse_float),
+    'current': command(b'MEAS:CURR?', parse_float),
+    'power': command(b'MEAS:POW?', parse_float),
+    'output': command(b'OUTP?', parse_bool),
+    'programmed_voltage': command(b'VOLT?', parse_float),
+    'programmed_current': command(b'CURR?', parse_float),
+    'max_voltage': command(b'VOLT? MAX', parse_float, SLOW),
+    'max_current': command(b'CURR? MAX', parse_float, SLOW),
+    'output_on': command(b'OUTP ON'),
+    'output_off': command(b'OUTP OFF'),
+    # setpoint write with read back, bind() the value before sending
+    'set_voltage': command(b'VOLT %s;VOLT?', parse_float, SLOW),
+    'set_current': command(b'CURR %s;CURR?', parse_float, SLOW),
+    # setpoint write without response for ramps and coalescing writers
+    'write_voltage': command(b'VOLT %s'),
+    'write_current': command(b'CURR %s'),
+}
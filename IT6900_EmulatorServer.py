@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Emulated IT6900 power supplies served over TCP sockets or pseudo terminals"""
+import argparse
+import os
+import socket
+import socketserver
+import sys
+import time
+from threading import Lock, Thread
+
+from EmultedIT6900AtComPort import EmultedIT6900AtComPort
+
+from config_logger import config_logger
+from log_exception import log_exception
+
+LF = b'\n'
+
+
+class EmulatedLine:
+    # one serial line (or LAN endpoint) with one or several emulated devices
+    def __init__(self, name, response_delay=None, **kwargs):
+        self.name = name
+        self.logger = kwargs.get('logger', config_logger())
+        self.emulator = EmultedIT6900AtComPort(name, **kwargs)
+        if response_delay is not None:
+            self.emulator.RESPONSE_DELAY = response_delay
+        self.request_count = 0
+        # lines from different connections are executed one by one
+        self.lock = Lock()
+        # pty slave fd kept open by serve_pty
+        self.slave = None
+
+    def process(self, line: bytes):
+        # execute one command line, returns response with LF or b''
+        self.request_count += 1
+        with self.lock:
+            self.emulator.write(line.strip() + LF)
+            if not self.emulator.response:
+                return b''
+            time.sleep(self.emulator.RESPONSE_DELAY)
+            return self.emulator.read()
+
+
+class LineHandler(socketserver.StreamRequestHandler):
+    def setup(self):
+        super().setup()
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def handle(self):
+        line = self.server.line
+        line.logger.debug('%s connection from %s', line.name, self.client_address)
+        while True:
+            data = self.rfile.readline()
+            if not data:
+                break
+            response = line.process(data)
+            if response:
+                self.wfile.write(response)
+        line.logger.debug('%s connection from %s closed', line.name, self.client_address)
+
+
+class LineServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, line):
+        self.line = line
+        super().__init__(address, LineHandler)
+
+
+def serve_tcp(line, host, port):
+    server = LineServer((host, port), line)
+    thread = Thread(target=server.serve_forever, name=f'{line.name} tcp', daemon=True)
+    thread.start()
+    return server
+
+
+def serve_pty(line, link=None):
+    # serve line at pseudo terminal, returns slave device name
+    import tty
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    name = os.ttyname(slave)
+    if link:
+        if os.path.islink(link):
+            os.remove(link)
+        os.symlink(name, link)
+        name = link
+
+    def run():
+        buffer = b''
+        while True:
+            try:
+                buffer += os.read(master, 1024)
+            except OSError:
+                # no slave side open
+                time.sleep(0.1)
+                continue
+            while LF in buffer:
+                data, buffer = buffer.split(LF, 1)
+                response = line.process(data)
+                if response:
+                    os.write(master, response)
+
+    Thread(target=run, name=f'{line.name} pty', daemon=True).start()
+    # keep slave open, so master read does not fail when client closes device
+    line.slave = slave
+    return name
+
+
+def parse_addresses(text):
+    # '1-4,7' -> [1, 2, 3, 4, 7]
+    if not text:
+        return None
+    result = []
+    for item in text.split(','):
+        first, _, last = item.partition('-')
+        result += list(range(int(first), int(last or first) + 1))
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve emulated IT6900 power supplies over TCP or pty')
+    parser.add_argument('-n', '--lines', type=int, default=1,
+                        help='number of independent lines (TCP ports or pty devices)')
+    parser.add_argument('--addresses', default=None,
+                        help='device addresses at each line, e.g. 1-16; default: one device without ADDR')
+    parser.add_argument('--host', default='127.0.0.1', help='TCP host to listen on')
+    parser.add_argument('--port', type=int, default=30000, help='TCP port of the first line')
+    parser.add_argument('--pty', action='store_true', help='serve lines at pseudo terminals instead of TCP')
+    parser.add_argument('--link', default=None,
+                        help='symlink prefix for pty devices, e.g. /tmp/ttyIT6900_ gives /tmp/ttyIT6900_0 ...')
+    parser.add_argument('--response-delay', type=float, default=EmultedIT6900AtComPort.RESPONSE_DELAY,
+                        help='response delay, s')
+    args = parser.parse_args(argv)
+
+    logger = config_logger()
+    addresses = parse_addresses(args.addresses)
+    servers = []
+    for i in range(args.lines):
+        line = EmulatedLine(f'IT6900EMU{i}', args.response_delay, addresses=addresses, logger=logger)
+        try:
+            if args.pty:
+                name = serve_pty(line, f'{args.link}{i}' if args.link else None)
+            else:
+                servers.append(serve_tcp(line, args.host, args.port + i))
+                name = f'{args.host}:{args.port + i}'
+        except KeyboardInterrupt:
+            raise
+        except:
+            log_exception(logger, f'Can not start line {i}')
+            return 1
+        print(f'{line.name} addresses {addresses if addresses else "-"} at {name}')
+        sys.stdout.flush()
+    try:
+        while True:
+            time.sleep(1.0)
+    except KeyboardInterrupt:
+        pass
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+"""Deadband filters for pushing Tango change and archive events"""
+
+
+class Deadband:
+    def __init__(self, absolute: float = 0.0, relative: float = 0.0, period: float = 0.0):
+        # absolute (float) - min absolute change to report, 0.0 - not used
+        # relative (float) - min relative change to report in percents, 0.0 - not used
+        # period (float) - report unchanged value after period, s, 0.0 - never
+        # without absolute and relative limits any change is reported
+        self.absolute = absolute
+        self.relative = relative
+        self.period = period
+        self.value = None
+        self.time = 0.0
+
+    def check(self, value, now: float) -> bool:
+        # returns True if value should be reported
+        if self.value is None or value is None:
+            return self.value is not value
+        if self.period > 0.0 and now - self.time >= self.period:
+            return True
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            return value != self.value
+        delta = abs(value - self.value)
+        if self.absolute <= 0.0 and self.relative <= 0.0:
+            return delta > 0.0
+        if 0.0 < self.absolute <= delta:
+            return True
+        if self.relative > 0.0 and delta * 100.0 >= self.relative * abs(self.value) and delta > 0.0:
+            return True
+        return False
+
+    def update(self, value, now: float):
+        self.value = value
+        self.time = now
+
+    def reset(self):
+        self.value = None
+        self.time = 0.0
@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Group of IT6900 family power supplies in one tango device"""
+import json
+import sys
+import os
+import time
+from threading import Thread
+
+from tango import AttrQuality, AttrWriteType, DispLevel
+from tango import DevState
+from tango.server import attribute, command
+
+if os.path.realpath('../TangoUtils') not in sys.path: sys.path.append(os.path.realpath('../TangoUtils'))
+import IT6900
+from IT6900_Acquisition import IT6900Acquisition, IT6900GroupAcquisition
+
+from TangoServerPrototype import TangoServerPrototype
+
+ORGANIZATION_NAME = 'BINP'
+APPLICATION_NAME = 'IT6900 family Power Supply Group Tango Device Server'
+APPLICATION_NAME_SHORT = 'IT6900_GroupServer'
+APPLICATION_VERSION = '1.0'
+# max number of devices in group
+MAX_DEVICES = 256
+
+
+def parse_devices(text):
+    # 'COM3:1, COM3:2, COM4' -> [('COM3', 1), ('COM3', 2), ('COM4', None)]
+    # address is used only if given, so 'COM3:1' devices share one port
+    # 'tcp://host:5025' is a LAN device, 'tcp://host:5025:1' - address 1 behind it
+    result = []
+    if isinstance(text, str):
+        text = text.replace(';', ',').split(',')
+    for item in text:
+        item = item.strip()
+        if not item:
+            continue
+        port, _, address = item.rpartition(':')
+        if '://' in item and port.count(':') < 2:
+            result.append((item, None))
+        elif port and address.isdigit():
+            result.append((port.strip(), int(address)))
+        else:
+            result.append((item, None))
+    return result
+
+
+class IT6900_GroupServer(TangoServerPrototype):
+    server_version_value = APPLICATION_VERSION
+    server_name_value = APPLICATION_NAME
+
+    device_count = attribute(label="Devices", dtype=int,
+                             display_level=DispLevel.OPERATOR,
+                             access=AttrWriteType.READ,
+                             unit="", format="%d",
+                             doc="Number of power supplies in the group")
+
+    ports = attribute(label="Ports", dtype=(str,),
+                      max_dim_x=MAX_DEVICES,
+                      display_level=DispLevel.OPERATOR,
+                      access=AttrWriteType.READ,
+                      doc="Port[:address] of power supplies")
+
+    online = attribute(label="Online", dtype=(bool,),
+                       max_dim_x=MAX_DEVICES,
+                       display_level=DispLevel.OPERATOR,
+                       access=AttrWriteType.READ,
+                       doc="Power supplies are online")
+
+    voltages = attribute(label="Voltages", dtype=(float,),
+                         max_dim_x=MAX_DEVICES,
+                         display_level=DispLevel.OPERATOR,
+                         access=AttrWriteType.READ,
+                         unit="V", format="%6.3f",
+                         doc="Measured voltages, NaN for offline devices")
+
+    currents = attribute(label="Currents", dtype=(float,),
+                         max_dim_x=MAX_DEVICES,
+                         display_level=DispLevel.OPERATOR,
+                         access=AttrWriteType.READ,
+                         unit="A", format="%6.3f",
+                         doc="Measured currents, NaN for offline devices")
+
+    powers = attribute(label="Powers", dtype=(float,),
+                       max_dim_x=MAX_DEVICES,
+                       display_level=DispLevel.OPERATOR,
+                       access=AttrWriteType.READ,
+                       unit="W", format="%8.3f",
+                       doc="Measured output powers, NaN for offline devices")
+
+    output_states = attribute(label="Outputs", dtype=(bool,),
+                              max_dim_x=MAX_DEVICES,
+                              display_level=DispLevel.OPERATOR,
+                              access=AttrWriteType.READ_WRITE,
+                              doc="Output on/off states")
+
+    programmed_voltages = attribute(label="Programmed Voltages", dtype=(float,),
+                                    max_dim_x=MAX_DEVICES,
+                                    display_level=DispLevel.OPERATOR,
+                                    access=AttrWriteType.READ_WRITE,
+                                    unit="V", format="%6.3f",
+                                    doc="Programmed voltages")
+
+    programmed_currents = attribute(label="Programmed Currents", dtype=(float,),
+                                    max_dim_x=MAX_DEVICES,
+                                    display_level=DispLevel.OPERATOR,
+                                    access=AttrWriteType.READ_WRITE,
+                                    unit="A", format="%6.3f",
+                                    doc="Programmed currents")
+
+    def init_device(self):
+        super().init_device()
+        msg = f'{self.get_name()} IT6900 group Initialization'
+        self.logger.info(msg)
+        self.set_state(DevState.INIT, msg)
+        kwargs = {'baudrate': self.config.get('baudrate', 115200),
+                  'logger': self.logger,
+                  'id_cache': self.config.get('id_cache', None),
+                  'port_lock': self.config.get('port_lock', 'y') == 'y',
+                  'lock_dir': self.config.get('lock_dir', None),
+                  # devices are opened and initialized in background, dead units do not delay startup
+                  'background_init': True}
+        tdklambda = self.config.pop('tdklambda', 'n')
+        device_class = IT6900.IT6900_Lambda if tdklambda == 'y' else IT6900.IT6900
+        self.coalesce_writes = self.config.get('coalesce_writes', 'n') == 'y'
+        self.devices = []
+        for port, address in parse_devices(self.config.get('devices', ''))[:MAX_DEVICES]:
+            self.devices.append(device_class(port, address=address, **kwargs))
+        # one acquisition thread per port, devices at one bus are polled in turn
+        period = float(self.config.get('acquisition_period', 1.0))
+        self.max_age = float(self.config.get('max_age', 3.0 * period))
+        self.acquisitions = [IT6900Acquisition(d, period, logger=self.logger) for d in self.devices]
+        groups = {}
+        for a in self.acquisitions:
+            groups.setdefault(a.device.port, []).append(a)
+        self.group_acquisitions = [IT6900GroupAcquisition(g, period, logger=self.logger) for g in groups.values()]
+        for g in self.group_acquisitions:
+            g.start()
+        # state is set when devices get online or after init_timeout
+        self.init_thread = Thread(target=self.finish_init, name=f'{self.get_name()} init', daemon=True)
+        self.init_thread.start()
+
+    def finish_init(self):
+        # all devices initialize in parallel, wait for them together
+        end_time = time.perf_counter() + float(self.config.get('init_timeout', 3.0))
+        for d in self.devices:
+            d.wait_ready(max(end_time - time.perf_counter(), 0.0))
+        n = sum(d.initialized() for d in self.devices)
+        if n == len(self.devices) and n > 0:
+            self.set_running(f'{self.get_name()} {n} devices initialized successfully')
+        else:
+            self.set_fault(f'{self.get_name()} {n} of {len(self.devices)} devices initialized')
+
+    def delete_device(self):
+        for g in self.group_acquisitions:
+            g.stop(1.0)
+        for d in self.devices:
+            d.close()
+        super().delete_device()
+        msg = '%s has been deleted' % self.get_name()
+        self.logger.info(msg)
+
+    def device_name(self, device):
+        if device.address is None:
+            return device.port
+        return f'{device.port}:{device.address}'
+
+    def values(self, name, wrong_value):
+        # cached values of all devices
+        result = []
+        for a in self.acquisitions:
+            v = a.get(name, self.max_age) if a.device.initialized() else None
+            result.append(wrong_value if v is None else v)
+        return result
+
+    def common_read(self, attrib, name, wrong_value):
+        values = self.values(name, wrong_value)
+        attrib.set_value(values)
+        if all(d.initialized() for d in self.devices):
+            attrib.set_quality(AttrQuality.ATTR_VALID)
+            self.set_running()
+        else:
+            attrib.set_quality(AttrQuality.ATTR_ALARM)
+            self.set_fault('Some devices are offline')
+        return values
+
+    def common_write(self, name, write_function, values):
+        # write only changed values
+        if len(values) != len(self.devices):
+            self.set_fault(f'Write of {len(values)} values to {len(self.devices)} devices')
+            return False
+        result = True
+        for a, value in zip(self.acquisitions, values):
+            if not a.device.initialized():
+                result = False
+                continue
+            if a.get(name, self.max_age) == value:
+                continue
+            if not write_function(a.device, value):
+                result = False
+            a.invalidate(name)
+        if result:
+            self.set_running()
+        else:
+            self.set_fault('Error writing to group')
+        return result
+
+    def read_device_count(self):
+        return len(self.devices)
+
+    def read_ports(self):
+        return [self.device_name(d) for d in self.devices]
+
+    def read_online(self):
+        return [d.initialized() for d in self.devices]
+
+    def read_voltages(self):
+        return self.common_read(self.voltages, 'voltage', float('nan'))
+
+    def read_currents(self):
+        return self.common_read(self.currents, 'current', float('nan'))
+
+    def read_powers(self):
+        return self.common_read(self.powers, 'power', float('nan'))
+
+    def read_output_states(self):
+        return self.common_read(self.output_states, 'output', False)
+
+    def write_output_states(self, values):
+        return self.common_write('output', lambda d, v: d.write_output(bool(v)), values)
+
+    def read_programmed_voltages(self):
+        return self.common_read(self.programmed_voltages, 'programmed_voltage', float('nan'))
+
+    def write_programmed_voltages(self, values):
+        if self.coalesce_writes:
+            return self.common_write('programmed_voltage', lambda d, v: d.set_voltage(v), values)
+        return self.common_write('programmed_voltage', lambda d, v: d.write_voltage(v), values)
+
+    def read_programmed_currents(self):
+        return self.common_read(self.programmed_currents, 'programmed_current', float('nan'))
+
+    def write_programmed_currents(self, values):
+        if self.coalesce_writes:
+            return self.common_write('programmed_current', lambda d, v: d.set_current(v), values)
+        return self.common_write('programmed_current', lambda d, v: d.write_current(v), values)
+
+    @command(dtype_in=str, doc_in='Port[:address] of device',
+             dtype_out=str, doc_out='JSON with all values of the device')
+    def read_device(self, name):
+        for d, a in zip(self.devices, self.acquisitions):
+            if self.device_name(d) == name:
+                values = dict(a.snapshot)
+                values['online'] = d.initialized()
+                values['type'] = d.type
+                return json.dumps(values)
+        return '{}'
+
+    @command(dtype_out=str, doc_out='I/O statistics of all devices in JSON')
+    def read_stats(self):
+        return json.dumps({self.device_name(d): d.stats() for d in self.devices})
+
+    @command
+    def reconnect(self):
+        for d in self.devices:
+            if not d.initialized():
+                d.reconnect()
+
+
+if __name__ == "__main__":
+    IT6900_GroupServer.run_server()
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""Voltage/current ramps executed by IT6900 driver on precise timer"""
+import math
+import time
+from threading import Thread, Event
+
+from log_exception import log_exception
+
+
+class Ramp:
+    # ramp states
+    IDLE = 'IDLE'
+    RUNNING = 'RUNNING'
+    DONE = 'DONE'
+    ABORTED = 'ABORTED'
+    FAILED = 'FAILED'
+
+    def __init__(self, device, command: bytes, target: float, rate: float, step: float, **kwargs):
+        # device (IT6900) - power supply
+        # command (bytes) - b'VOLT' or b'CURR'
+        # target (float) - final setpoint
+        # rate (float) - ramp rate, units per second
+        # step (float) - setpoint step
+        if rate <= 0.0 or step <= 0.0:
+            raise ValueError('Ramp rate and step should be positive')
+        self.device = device
+        self.command = command
+        self.target = target
+        self.rate = rate
+        self.step = step
+        # precompiled write command if known for the device
+        self.write_command = getattr(device, 'WRITE_COMMANDS', {}).get(command)
+        self.logger = kwargs.get('logger', device.logger)
+        self.state = self.IDLE
+        self.value = None
+        self.start_value = None
+        self.step_count = 0
+        # max lag of step behind schedule, s
+        self.max_lag = 0.0
+        self.abort_event = Event()
+        self.thread = None
+
+    def start(self, start_value: float):
+        self.start_value = start_value
+        self.value = start_value
+        self.state = self.RUNNING
+        self.thread = Thread(target=self.run, name=f'IT6900 {self.command.decode()} ramp {self.device.port}',
+                             daemon=True)
+        self.thread.start()
+
+    def abort(self):
+        self.abort_event.set()
+
+    def wait(self, timeout=None):
+        if self.thread is not None:
+            self.thread.join(timeout)
+        return self.state
+
+    def running(self):
+        return self.state == self.RUNNING
+
+    def schedule(self):
+        # list of (time offset, setpoint) for all steps
+        delta = self.target - self.start_value
+        n = max(int(math.ceil(abs(delta) / self.step)), 1)
+        duration = abs(delta) / self.rate
+        return [(duration * k / n, self.start_value + delta * k / n) for k in range(1, n + 1)]
+
+    def run(self):
+        try:
+            t0 = time.perf_counter()
+            for dt, value in self.schedule():
+                delay = t0 + dt - time.perf_counter()
+                if delay > 0.0 and self.abort_event.wait(delay):
+                    break
+                if self.abort_event.is_set():
+                    break
+                self.max_lag = max(self.max_lag, -delay)
+                # pipelined write without read back
+                if self.write_command is not None:
+                    cmd = self.write_command.bind(round(value, 6))
+                else:
+                    cmd = self.command + b' ' + str(round(value, 6)).encode()
+                if not self.device.send_command(cmd, False):
+                    self.state = self.FAILED
+                    break
+                self.value = value
+                self.step_count += 1
+            if self.abort_event.is_set():
+                self.state = self.ABORTED
+            elif self.state == self.RUNNING:
+                # verify final setpoint once
+                if self.device.write_value(self.command, float(self.target)):
+                    self.state = self.DONE
+                else:
+                    self.state = self.FAILED
+        except KeyboardInterrupt:
+            raise
+        except:
+            self.state = self.FAILED
+            log_exception(self.logger, f'{self.device.pre} Ramp exception')
+        # cached values of coalescing writers do not match the device after ramp steps
+        invalidate = getattr(self.device, 'invalidate_setpoints', None)
+        if invalidate is not None:
+            invalidate(self.command)
+        self.logger.debug('%s %s ramp to %s %s after %s steps, max lag %4.1f ms', self.device.pre, self.command,
+                          self.target, self.state, self.step_count, self.max_lag * 1000.0)
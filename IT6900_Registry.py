@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""Registry of IT6900 devices and OS level port locks shared between processes"""
+import os
+import re
+import tempfile
+from threading import Lock
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+
+
+class PortLock:
+    # exclusive lock file for a port, held while the port is open in this process
+    def __init__(self, port: str, lock_dir: str = None, file_name: str = None):
+        # file_name (str) - lock file to use instead of one derived from port, e.g. for shared files
+        self.port = port
+        if file_name is None:
+            if lock_dir is None:
+                lock_dir = tempfile.gettempdir()
+            name = re.sub(r'[^A-Za-z0-9_.-]', '_', port.strip())
+            file_name = os.path.join(lock_dir, f'IT6900_{name}.lock')
+        self.file_name = file_name
+        self.file = None
+
+    def acquire(self, blocking: bool = False) -> bool:
+        # returns False if locked by other process, blocking waits for release
+        if self.file is not None:
+            return True
+        f = open(self.file_name, 'a+')
+        try:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            elif msvcrt is not None:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK, 1)
+        except OSError:
+            f.close()
+            return False
+        # owner pid for diagnostics
+        f.seek(0)
+        f.truncate()
+        f.write(str(os.getpid()))
+        f.flush()
+        self.file = f
+        return True
+
+    def release(self):
+        if self.file is None:
+            return
+        try:
+            if fcntl is not None:
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+            elif msvcrt is not None:
+                self.file.seek(0)
+                msvcrt.locking(self.file.fileno(), msvcrt.LK_UNLCK, 1)
+        finally:
+            self.file.close()
+            self.file = None
+
+    def owner(self):
+        # pid of process holding the lock file, None if unknown
+        try:
+            with open(self.file_name) as f:
+                return int(f.read().strip())
+        except (OSError, ValueError):
+            return None
+
+
+class IT6900Registry:
+    # devices by (port, address) and port locks by port, one per process
+    _devices = {}
+    _port_locks = {}
+    _port_counts = {}
+    _lock = Lock()
+
+    @classmethod
+    def key(cls, port, address=None):
+        return port.strip(), address
+
+    @classmethod
+    def register(cls, device):
+        # returns previously registered device with the same port and address or None
+        key = cls.key(device.port, device.address)
+        with cls._lock:
+            old = cls._devices.get(key)
+            cls._devices[key] = device
+        if old is device:
+            return None
+        return old
+
+    @classmethod
+    def unregister(cls, device):
+        key = cls.key(device.port, device.address)
+        with cls._lock:
+            if cls._devices.get(key) is device:
+                del cls._devices[key]
+
+    @classmethod
+    def find(cls, port, address=None):
+        return cls._devices.get(cls.key(port, address))
+
+    @classmethod
+    def devices(cls):
+        with cls._lock:
+            return list(cls._devices.values())
+
+    @classmethod
+    def lock_port(cls, port, lock_dir=None) -> bool:
+        # take OS lock for port, counted for several openings in one process
+        port = port.strip()
+        with cls._lock:
+            if cls._port_counts.get(port, 0) > 0:
+                cls._port_counts[port] += 1
+                return True
+            lock = PortLock(port, lock_dir)
+            if not lock.acquire():
+                return False
+            cls._port_locks[port] = lock
+            cls._port_counts[port] = 1
+            return True
+
+    @classmethod
+    def unlock_port(cls, port):
+        port = port.strip()
+        with cls._lock:
+            n = cls._port_counts.get(port, 0) - 1
+            if n > 0:
+                cls._port_counts[port] = n
+                return
+            cls._port_counts.pop(port, None)
+            lock = cls._port_locks.pop(port, None)
+        if lock is not None:
+            lock.release()
+
+    @classmethod
+    def port_owner(cls, port, lock_dir=None):
+        return PortLock(port, lock_dir).owner()
@@ -1,8 +1,11 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 """IT6900 family power supply tango device server"""
+import json
 import sys
 import os
+import time
+from threading import Thread
 
 from tango import AttrQuality, AttrWriteType, DispLevel
 from tango import DevState
@@ -10,6 +13,8 @@ from tango.server import Device, attribute, command
 
 if os.path.realpath('../TangoUtils') not in sys.path: sys.path.append(os.path.realpath('../TangoUtils'))
 import IT6900
+from IT6900_Acquisition import IT6900Acquisition
+from IT6900_Events import Deadband
 
 from TangoServerPrototype import TangoServerPrototype
 
@@ -17,11 +22,15 @@ ORGANIZATION_NAME = 'BINP'
 APPLICATION_NAME = 'IT6900 family Power Supply Tango Device Server'
 APPLICATION_NAME_SHORT = 'IT6900_Server'
 APPLICATION_VERSION = '1.5'
+# max length of waveform attributes
+STREAM_MAX_SIZE = 100000
 
 
 class IT6900_Server(TangoServerPrototype):
     server_version_value = APPLICATION_VERSION
     server_name_value = APPLICATION_NAME
+    # acquisition snapshot key: attribute with change and archive events
+    EVENT_ATTRIBUTES = {'voltage': 'voltage', 'current': 'current', 'power': 'power', 'output': 'output_state'}
 
     port = attribute(label="Port", dtype=str,
                      display_level=DispLevel.OPERATOR,
@@ -76,6 +85,77 @@ class IT6900_Server(TangoServerPrototype):
                       min_value=0.0,
                       doc="Measured output power")
 
+    io_latency_p50 = attribute(label="I/O latency p50", dtype=float,
+                               display_level=DispLevel.EXPERT,
+                               access=AttrWriteType.READ,
+                               unit="ms", format="%6.1f",
+                               doc="Median latency of serial transactions")
+
+    io_latency_p99 = attribute(label="I/O latency p99", dtype=float,
+                               display_level=DispLevel.EXPERT,
+                               access=AttrWriteType.READ,
+                               unit="ms", format="%6.1f",
+                               doc="99th percentile latency of serial transactions")
+
+    io_error_count = attribute(label="I/O errors", dtype=int,
+                               display_level=DispLevel.EXPERT,
+                               access=AttrWriteType.READ,
+                               unit="", format="%d",
+                               doc="Number of failed serial transactions")
+
+    ramp_state = attribute(label="Ramp state", dtype=str,
+                           display_level=DispLevel.OPERATOR,
+                           access=AttrWriteType.READ,
+                           unit="", format="%s",
+                           doc="State of the last setpoint ramp: IDLE, RUNNING, DONE, ABORTED or FAILED")
+
+    streaming = attribute(label="Streaming", dtype=bool,
+                          display_level=DispLevel.OPERATOR,
+                          access=AttrWriteType.READ,
+                          unit="", format="",
+                          doc="High rate voltage/current streaming is running")
+
+    stream_rate = attribute(label="Stream rate", dtype=float,
+                            display_level=DispLevel.EXPERT,
+                            access=AttrWriteType.READ,
+                            unit="Hz", format="%6.1f",
+                            doc="Mean streaming sampling rate")
+
+    waveform_length = attribute(label="Waveform length", dtype=int,
+                                display_level=DispLevel.OPERATOR,
+                                access=AttrWriteType.READ_WRITE,
+                                unit="", format="%d",
+                                min_value=1,
+                                doc="Number of last stream samples in waveforms")
+
+    waveform_decimation = attribute(label="Waveform decimation", dtype=int,
+                                    display_level=DispLevel.OPERATOR,
+                                    access=AttrWriteType.READ_WRITE,
+                                    unit="", format="%d",
+                                    min_value=1,
+                                    doc="Waveform decimation factor, groups of samples are averaged")
+
+    voltage_waveform = attribute(label="Voltage waveform", dtype=(float,),
+                                 max_dim_x=STREAM_MAX_SIZE,
+                                 display_level=DispLevel.OPERATOR,
+                                 access=AttrWriteType.READ,
+                                 unit="V", format="%6.3f",
+                                 doc="Last streamed voltage samples")
+
+    current_waveform = attribute(label="Current waveform", dtype=(float,),
+                                 max_dim_x=STREAM_MAX_SIZE,
+                                 display_level=DispLevel.OPERATOR,
+                                 access=AttrWriteType.READ,
+                                 unit="A", format="%6.3f",
+                                 doc="Last streamed current samples")
+
+    time_waveform = attribute(label="Time waveform", dtype=(float,),
+                              max_dim_x=STREAM_MAX_SIZE,
+                              display_level=DispLevel.OPERATOR,
+                              access=AttrWriteType.READ,
+                              unit="s", format="%f",
+                              doc="Time stamps of streamed samples")
+
     def init_device(self):
         super().init_device()
         msg = f'{self.get_name()} IT6900 Initialization'
@@ -84,31 +164,121 @@ class IT6900_Server(TangoServerPrototype):
         kwargs = {}
         args = ()
         port = self.config.get('port', 'COM3')
+        # LAN device: SCPI over TCP socket instead of COM port
+        host = self.config.get('host', '')
+        if host:
+            port = f"tcp://{host}:{self.config.get('tcp_port', 5025)}"
         baud = self.config.get('baudrate', 115200)
         kwargs['baudrate'] = baud
         kwargs['logger'] = self.logger
+        # file to keep device limits between restarts
+        kwargs['id_cache'] = self.config.get('id_cache', None)
+        # read timeout, s, adaptive timeouts are learned from command latencies up to it
+        kwargs['read_timeout'] = float(self.config.get('read_timeout', 0.3))
+        kwargs['adaptive_timeout'] = self.config.get('adaptive_timeout', 'y') == 'y'
+        kwargs['timeout_factor'] = float(self.config.get('timeout_factor', 3.0))
+        # number of recent transactions kept for dump_trace command, 0 - disabled
+        kwargs['trace_size'] = int(self.config.get('trace_size', 256))
+        # file to record port traffic for replay, 'replay://file' as port plays it back
+        kwargs['record'] = self.config.get('record', None)
+        # lock file against opening the port by other processes
+        kwargs['port_lock'] = self.config.get('port_lock', 'y') == 'y'
+        kwargs['lock_dir'] = self.config.get('lock_dir', None)
+        # setpoint verification
+        kwargs['setpoint_tolerance'] = float(self.config.get('setpoint_tolerance', 1e-3))
+        kwargs['verify_every'] = int(self.config.get('verify_every', 0))
+        # write setpoints in background coalescing bursts
+        self.coalesce_writes = self.config.get('coalesce_writes', 'n') == 'y'
+        # device is opened and initialized in background, server is exported at once in INIT state
+        kwargs['background_init'] = True
         tdklambda = self.config.pop('tdklambda', 'n')
         if tdklambda == 'y':
             self.it6900 = IT6900.IT6900_Lambda(port, *args, **kwargs)
         else:
             self.it6900 = IT6900.IT6900(port, *args, **kwargs)
-        if self.it6900.initialized():
-            # max voltage and current
-            self.programmed_voltage.set_max_value(self.it6900.max_voltage)
-            self.programmed_current.set_max_value(self.it6900.max_current)
-            self.programmed_voltage.set_write_value(self.read_programmed_voltage())
-            self.programmed_current.set_write_value(self.read_programmed_current())
-            self.output_state.set_write_value(self.read_output_state())
-            # set state to running
-            msg = '%s %s at %s initialized successfully' % (self.get_name(), self.it6900.type, self.it6900.port)
-            self.set_running(msg)
-        else:
-            msg = '%s initialization error' % self.get_name()
-            self.set_fault(msg)
+        # background acquisition, disabled if period <= 0
+        self.acquisition = None
+        events = self.config.get('events', 'n') == 'y'
+        # local history store, disabled if store_dir is empty
+        store_dir = self.config.get('store_dir', '')
+        # events and history need acquisition, 1 s period by default
+        period = float(self.config.get('acquisition_period', 1.0 if events or store_dir else 0.0))
+        # max age of cached values, s
+        self.max_age = float(self.config.get('max_age', 3.0 * period))
+        if period > 0.0:
+            self.acquisition = IT6900Acquisition(self.it6900, period, logger=self.logger)
+        # change and archive events from acquisition with deadbands
+        self.change_deadbands = {}
+        self.archive_deadbands = {}
+        if events and self.acquisition is not None:
+            for name in self.EVENT_ATTRIBUTES.values():
+                self.change_deadbands[name] = Deadband(float(self.config.get(name + '_abs_change', 0.0)),
+                                                       float(self.config.get(name + '_rel_change', 0.0)))
+                self.archive_deadbands[name] = Deadband(float(self.config.get(name + '_archive_abs_change', 0.0)),
+                                                        float(self.config.get(name + '_archive_rel_change', 0.0)),
+                                                        float(self.config.get('archive_period', 0.0)))
+                self.set_change_event(name, True, False)
+                self.set_archive_event(name, True, False)
+            self.acquisition.callbacks.append(self.push_events)
+        # acquired values are appended to memory mapped chunk files
+        self.store = None
+        if store_dir and self.acquisition is not None:
+            # numpy is loaded only when history is stored
+            from IT6900_Store import IT6900Store
+            self.store = IT6900Store(store_dir, logger=self.logger,
+                                     prefix=self.get_name().replace('/', '_'),
+                                     chunk_size=int(self.config.get('store_chunk_size', 65536)),
+                                     rotate_period=float(self.config.get('store_rotate_period', 86400.0)),
+                                     retention=float(self.config.get('store_retention', 30 * 86400.0)))
+            self.acquisition.callbacks.append(self.store.append_snapshot)
+        if self.acquisition is not None:
+            self.acquisition.start()
+        # high rate streaming, created by start_streaming command
+        self.stream = None
+        self.stream_size = min(int(self.config.get('stream_size', 10000)), STREAM_MAX_SIZE)
+        self.stream_event_period = float(self.config.get('stream_event_period', 0.5))
+        self.stream_event_time = 0.0
+        self.stream_event_counter = 0
+        self.waveform_length_value = self.stream_size
+        self.waveform_decimation_value = 1
+        for name in ('voltage_waveform', 'current_waveform', 'time_waveform'):
+            self.set_change_event(name, True, False)
+            self.set_data_ready_event(name, True)
+        # finish initialization when device gets online
+        self.init_thread = Thread(target=self.finish_init, name=f'{self.get_name()} init', daemon=True)
+        self.init_thread.start()
+
+    def finish_init(self):
+        init_timeout = float(self.config.get('init_timeout', 3.0))
+        if not self.it6900.wait_ready(init_timeout):
+            if self.config.get('auto_baud', 'n') == 'y':
+                self.it6900.detect_baud()
+            if not self.it6900.ready:
+                msg = '%s initialization error' % self.get_name()
+                self.set_fault(msg)
+        # recovery continues in background until device is online or deleted
+        while not self.it6900.closed and not self.it6900.wait_ready(1.0):
+            pass
+        if self.it6900.closed:
+            return
+        # max voltage and current
+        self.programmed_voltage.set_max_value(self.it6900.max_voltage)
+        self.programmed_current.set_max_value(self.it6900.max_current)
+        self.programmed_voltage.set_write_value(self.read_programmed_voltage())
+        self.programmed_current.set_write_value(self.read_programmed_current())
+        self.output_state.set_write_value(self.read_output_state())
+        # set state to running
+        msg = '%s %s at %s initialized successfully' % (self.get_name(), self.it6900.type, self.it6900.port)
+        self.set_running(msg)
 
     def delete_device(self):
-        self.it6900.ready = False
-        self.it6900.close_com_port()
+        if self.stream is not None:
+            self.stream.stop(1.0)
+        if self.acquisition is not None:
+            self.acquisition.stop(1.0)
+        if self.store is not None:
+            self.store.close()
+        self.it6900.close()
         super().delete_device()
         msg = '%s has been deleted' % self.get_name()
         self.logger.info(msg)
@@ -123,14 +293,19 @@ class IT6900_Server(TangoServerPrototype):
             return self.it6900.type
         return "Uninitialized"
 
-    def common_read(self, read_function, attrib, wrong_value=None):
+    def common_read(self, read_function, attrib, wrong_value=None, name=None):
+        # name - key of cached value in acquisition snapshot
         if not self.it6900.initialized():
             attrib.set_value(wrong_value)
             attrib.set_quality(AttrQuality.ATTR_INVALID)
             msg = "Read from offline device %s" % self.name
             self.set_fault(msg)
             return wrong_value
-        value = read_function()
+        value = None
+        if name is not None and self.acquisition is not None:
+            value = self.acquisition.get(name, self.max_age)
+        if value is None:
+            value = read_function()
         if value is not None:
             attrib.set_value(value)
             attrib.set_quality(AttrQuality.ATTR_VALID)
@@ -143,13 +318,17 @@ class IT6900_Server(TangoServerPrototype):
             self.set_fault(msg)
             return wrong_value
 
-    def common_write(self, write_function, attrib, value):
+    def common_write(self, write_function, attrib, value, name=None):
+        # name - key of cached value in acquisition snapshot
         if not self.it6900.initialized():
             attrib.set_quality(AttrQuality.ATTR_INVALID)
             msg = "Write to offline device %s" % self.name
             self.set_fault(msg)
             return False
-        if write_function(value):
+        result = write_function(value)
+        if name is not None and self.acquisition is not None:
+            self.acquisition.invalidate(name)
+        if result:
             attrib.set_quality(AttrQuality.ATTR_VALID)
             self.set_running()
             return True
@@ -159,7 +338,7 @@ class IT6900_Server(TangoServerPrototype):
         return False
 
     def read_output_state(self):
-        return self.common_read(self.it6900.read_output, self.output_state, False)
+        return self.common_read(self.it6900.read_output, self.output_state, False, 'output')
         # if self.it6900.initialized():
         #     value = self.it6900.read_output()
         #     if value is not None:
@@ -178,13 +357,13 @@ class IT6900_Server(TangoServerPrototype):
         # return value
 
     def write_output_state(self, value):
-        return self.common_write(self.it6900.write_output, self.output_state, value)
+        return self.common_write(self.it6900.write_output, self.output_state, value, 'output')
 
     def read_power(self):
-        return self.common_read(self.it6900.read_power, self.power)
+        return self.common_read(self.it6900.read_power, self.power, None, 'power')
 
     def read_voltage(self):
-        return self.common_read(self.it6900.read_voltage, self.voltage, float('nan'))
+        return self.common_read(self.it6900.read_voltage, self.voltage, float('nan'), 'voltage')
         # if self.it6900.initialized():
         #     value = self.it6900.read_voltage()
         #     if value is not None:
@@ -203,7 +382,7 @@ class IT6900_Server(TangoServerPrototype):
         # return value
 
     def read_current(self):
-        return self.common_read(self.it6900.read_current, self.current, float('nan'))
+        return self.common_read(self.it6900.read_current, self.current, float('nan'), 'current')
         # if self.it6900.initialized():
         #     value = self.it6900.read_current()
         #     if value is not None:
@@ -222,7 +401,7 @@ class IT6900_Server(TangoServerPrototype):
         # return value
 
     def read_programmed_voltage(self):
-        return self.common_read(self.it6900.read_programmed_voltage, self.programmed_voltage, float('nan'))
+        return self.common_read(self.it6900.read_programmed_voltage, self.programmed_voltage, float('nan'), 'programmed_voltage')
         # if self.it6900.initialized():
         #     value = self.it6900.read_programmed_voltage()
         #     if value is not None:
@@ -241,7 +420,7 @@ class IT6900_Server(TangoServerPrototype):
         # return value
 
     def read_programmed_current(self):
-        return self.common_read(self.it6900.read_programmed_current, self.programmed_current, float('nan'))
+        return self.common_read(self.it6900.read_programmed_current, self.programmed_current, float('nan'), 'programmed_current')
         # if self.it6900.initialized():
         #     value = self.it6900.read_programmed_current()
         #     if value is not None:
@@ -260,7 +439,9 @@ class IT6900_Server(TangoServerPrototype):
         # return value
 
     def write_programmed_voltage(self, value):
-        return self.common_write(self.it6900.write_voltage, self.programmed_voltage, value)
+        if self.coalesce_writes:
+            return self.common_write(self.it6900.set_voltage, self.programmed_voltage, value, 'programmed_voltage')
+        return self.common_write(self.it6900.write_voltage, self.programmed_voltage, value, 'programmed_voltage')
         # if not self.it6900.initialized():
         #     msg = "Writing to offline device %s" % self.name
         #     self.logger.warning(msg)
@@ -277,7 +458,9 @@ class IT6900_Server(TangoServerPrototype):
         # return result
 
     def write_programmed_current(self, value):
-        return self.common_write(self.it6900.write_current, self.programmed_current, value)
+        if self.coalesce_writes:
+            return self.common_write(self.it6900.set_current, self.programmed_current, value, 'programmed_current')
+        return self.common_write(self.it6900.write_current, self.programmed_current, value, 'programmed_current')
         # if not self.it6900.initialized():
         #     self.programmed_voltage.set_quality(AttrQuality.ATTR_INVALID)
         #     msg = "Writing to offline device %s" % self.name
@@ -294,6 +477,151 @@ class IT6900_Server(TangoServerPrototype):
         #     self.set_fault()
         # return result
 
+    def push_events(self, snapshot):
+        # called from acquisition thread after each refresh
+        now = snapshot['time']
+        for key, name in self.EVENT_ATTRIBUTES.items():
+            value = snapshot.get(key)
+            if value is None:
+                quality = AttrQuality.ATTR_INVALID
+                data = False if name == 'output_state' else float('nan')
+            else:
+                quality = AttrQuality.ATTR_VALID
+                data = value
+            deadband = self.change_deadbands[name]
+            if deadband.check(value, now):
+                deadband.update(value, now)
+                self.push_change_event(name, data, now, quality)
+            deadband = self.archive_deadbands[name]
+            if deadband.check(value, now):
+                deadband.update(value, now)
+                self.push_archive_event(name, data, now, quality)
+
+    def read_ramp_state(self):
+        return self.it6900.ramp_state
+
+    def start_ramp(self, command, args):
+        if len(args) != 3:
+            self.set_fault('Ramp arguments should be [target, rate, step]')
+            return False
+        try:
+            ramp = self.it6900.ramp(args[0], args[1], args[2], command)
+        except ValueError as e:
+            ramp = None
+            self.logger.warning('%s %s', self.get_name(), e)
+        if ramp is None:
+            self.set_fault('Ramp can not be started')
+            return False
+        self.set_running('Ramp started')
+        return True
+
+    @command(dtype_in=[float], doc_in='[target, rate, step] in V, V/s, V',
+             dtype_out=bool, doc_out='True if ramp has been started')
+    def ramp_voltage(self, args):
+        return self.start_ramp(b'VOLT', args)
+
+    @command(dtype_in=[float], doc_in='[target, rate, step] in A, A/s, A',
+             dtype_out=bool, doc_out='True if ramp has been started')
+    def ramp_current(self, args):
+        return self.start_ramp(b'CURR', args)
+
+    @command
+    def abort_ramp(self):
+        self.it6900.abort_ramp(1.0)
+
+    def read_streaming(self):
+        return self.stream is not None and self.stream.running()
+
+    def read_stream_rate(self):
+        if self.stream is None:
+            return 0.0
+        return self.stream.rate
+
+    def read_waveform_length(self):
+        return self.waveform_length_value
+
+    def write_waveform_length(self, value):
+        self.waveform_length_value = min(value, self.stream_size)
+
+    def read_waveform_decimation(self):
+        return self.waveform_decimation_value
+
+    def write_waveform_decimation(self, value):
+        self.waveform_decimation_value = max(value, 1)
+
+    def waveforms(self):
+        # (time, voltage, current) arrays of last samples after decimation
+        if self.stream is None:
+            return [], [], []
+        rows = self.stream.buffer.last(self.waveform_length_value, self.waveform_decimation_value, 'mean')
+        return rows[:, 0], rows[:, 1], rows[:, 2]
+
+    def read_voltage_waveform(self):
+        return self.waveforms()[1]
+
+    def read_current_waveform(self):
+        return self.waveforms()[2]
+
+    def read_time_waveform(self):
+        return self.waveforms()[0]
+
+    def stream_callback(self, stream):
+        # called from streaming thread after each sample, pushes events not often than stream_event_period
+        now = time.time()
+        if now - self.stream_event_time < self.stream_event_period:
+            return
+        self.stream_event_time = now
+        self.stream_event_counter += 1
+        t, v, i = self.waveforms()
+        for name, value in (('time_waveform', t), ('voltage_waveform', v), ('current_waveform', i)):
+            self.push_change_event(name, value)
+            self.push_data_ready_event(name, self.stream_event_counter)
+
+    @command
+    def start_streaming(self):
+        if self.stream is None:
+            # numpy is loaded only when streaming is used
+            from IT6900_Stream import IT6900Stream
+            self.stream = IT6900Stream(self.it6900, self.stream_size, float(self.config.get('stream_period', 0.0)),
+                                       logger=self.logger, callbacks=(self.stream_callback,))
+        self.stream.start()
+
+    @command
+    def stop_streaming(self):
+        if self.stream is not None:
+            self.stream.stop(1.0)
+
+    def read_io_latency_p50(self):
+        return self.it6900.io_stats.latency.percentile(50.0) * 1000.0
+
+    def read_io_latency_p99(self):
+        return self.it6900.io_stats.latency.percentile(99.0) * 1000.0
+
+    def read_io_error_count(self):
+        return self.it6900.io_stats.io_error_count
+
+    @command(dtype_in=[float], doc_in='[start time, stop time, max points], epoch seconds, stop 0 - now',
+             dtype_out=str, doc_out='JSON with time, voltage, current, power and output lists')
+    def read_history(self, value):
+        if self.store is None:
+            return '{}'
+        start = value[0] if len(value) > 0 else 0.0
+        stop = value[1] if len(value) > 1 and value[1] > 0.0 else time.time() + 1.0
+        max_points = int(value[2]) if len(value) > 2 else 1000
+        return json.dumps(self.store.query(start, stop, max_points))
+
+    @command(dtype_out=str, doc_out='I/O statistics in JSON, latency in seconds')
+    def read_stats(self):
+        return json.dumps(self.it6900.stats())
+
+    @command
+    def reset_stats(self):
+        self.it6900.reset_stats()
+
+    @command(dtype_out=str, doc_out='Recent I/O transactions, the oldest first')
+    def dump_trace(self):
+        return self.it6900.dump_trace()
+
     @command
     def reconnect(self):
         self.it6900.reconnect()
@@ -310,11 +638,15 @@ class IT6900_Server(TangoServerPrototype):
     @command(dtype_in=str, doc_in='Directly send command to the device',
              dtype_out=str, doc_out='Response from device without final LF')
     def send_command(self, cmd):
-        if self.it6900.send_command(cmd):
+        # arbitrary command may change setpoints
+        self.it6900.invalidate_setpoints()
+        # response is taken under device lock, acquisition and writers share the device
+        response = self.it6900.exchange(cmd)
+        if response is not None:
             self.set_running('Command Ok')
-        else:
-            self.set_fault('Command Error')
-        return self.it6900.response[:-1].decode()
+            return response[:-1].decode()
+        self.set_fault('Command Error')
+        return ''
 
 
 if __name__ == "__main__":
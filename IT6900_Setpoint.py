@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""Coalescing writer for IT6900 voltage and current setpoints"""
+from threading import Thread, Condition
+
+from log_exception import log_exception
+
+
+class SetpointWriter:
+    def __init__(self, device, command: bytes, **kwargs):
+        # device (IT6900) - power supply
+        # command (bytes) - setpoint command, b'VOLT' or b'CURR'
+        self.device = device
+        self.command = command
+        # precompiled commands if known for the device
+        self.query = getattr(device, 'READ_COMMANDS', {}).get(command, command + b'?')
+        self.write_command = getattr(device, 'WRITE_COMMANDS', {}).get(command)
+        self.logger = kwargs.get('logger', device.logger)
+        # max difference between written and read back value
+        self.tolerance = kwargs.get('tolerance', 1e-3)
+        # verify every n-th write during a burst, 0 - only at the end of the burst
+        self.verify_every = kwargs.get('verify_every', 0)
+        self.condition = Condition()
+        # value waiting to be written, None - nothing to write
+        self.pending = None
+        # last written and not yet failed value, None - unknown
+        self.value = None
+        self.busy = False
+        self.write_count = 0
+        self.skip_count = 0
+        self.coalesce_count = 0
+        self.error_count = 0
+        # last verification failed
+        self.error = False
+        self.thread = None
+
+    def set(self, value: float):
+        # queue value for writing, returns at once
+        with self.condition:
+            if self.pending is not None:
+                self.coalesce_count += 1
+            self.pending = value
+            self.condition.notify_all()
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = Thread(target=self.run, name=f'IT6900 {self.command.decode()} writer {self.device.port}',
+                                     daemon=True)
+                self.thread.start()
+        return True
+
+    def flush(self, timeout=None):
+        # wait until pending value is written, returns False on timeout
+        with self.condition:
+            return self.condition.wait_for(lambda: self.pending is None and not self.busy, timeout)
+
+    def invalidate(self):
+        # setpoint may be changed by other means
+        self.value = None
+
+    def run(self):
+        n = 0
+        while True:
+            with self.condition:
+                if not self.condition.wait_for(lambda: self.pending is not None, 10.0):
+                    # finish idle thread, it is restarted by set()
+                    self.thread = None
+                    return
+                value = self.pending
+                self.pending = None
+                self.busy = True
+            try:
+                if self.value is not None and abs(value - self.value) <= self.tolerance / 2.0:
+                    self.skip_count += 1
+                elif self.write(value):
+                    n += 1
+                    # verify at the end of burst or every verify_every writes
+                    if self.pending is None or (self.verify_every > 0 and n % self.verify_every == 0):
+                        self.verify(value)
+            except KeyboardInterrupt:
+                raise
+            except:
+                self.value = None
+                log_exception(self.logger, f'{self.device.pre} Setpoint writer exception')
+            with self.condition:
+                self.busy = False
+                self.condition.notify_all()
+
+    def write(self, value):
+        if self.write_command is not None:
+            cmd = self.write_command.bind(value)
+        else:
+            cmd = self.command + b' ' + str(value).encode()
+        if self.device.send_command(cmd, False):
+            self.value = value
+            self.write_count += 1
+            return True
+        self.value = None
+        self.error = True
+        self.error_count += 1
+        return False
+
+    def verify(self, value):
+        v = self.device.read_value(self.query)
+        if v is not None and abs(v - value) <= self.tolerance:
+            self.error = False
+            return True
+        self.value = None
+        self.error = True
+        self.error_count += 1
+        self.logger.info('%s %s verification error %s != %s', self.device.pre, self.command, v, value)
+        return False
+
+    def stats(self):
+        return {'writes': self.write_count, 'skipped': self.skip_count,
+                'coalesced': self.coalesce_count, 'errors': self.error_count}
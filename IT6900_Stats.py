@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""I/O statistics for IT6900: latency histograms and counters"""
+import math
+
+
+class LatencyHistogram:
+    # HDR style histogram: SUB_BUCKETS linear buckets in every power of 2 microseconds,
+    # relative error of percentiles is below 1 / SUB_BUCKETS
+    SUB_BUCKETS = 32
+
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.sum = 0.0
+        self.min = float('inf')
+        self.max = 0.0
+
+    def record(self, value: float):
+        # value - time in seconds
+        i = self.index(value)
+        self.counts[i] = self.counts.get(i, 0) + 1
+        self.count += 1
+        self.sum += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        # add counts of other histogram, e.g. collected in another thread
+        for i, n in list(other.counts.items()):
+            self.counts[i] = self.counts.get(i, 0) + n
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def index(self, value):
+        us = value * 1e6
+        if us < 1.0:
+            return 0
+        m, e = math.frexp(us)
+        return (e - 1) * self.SUB_BUCKETS + int((2.0 * m - 1.0) * self.SUB_BUCKETS) + 1
+
+    def value(self, index):
+        # middle of the bucket in seconds
+        if index <= 0:
+            return 0.0
+        e, sub = divmod(index - 1, self.SUB_BUCKETS)
+        return (1.0 + (sub + 0.5) / self.SUB_BUCKETS) * 2.0 ** e * 1e-6
+
+    @property
+    def mean(self):
+        if self.count <= 0:
+            return 0.0
+        return self.sum / self.count
+
+    def percentile(self, p: float):
+        # p in percents, returns seconds
+        if self.count <= 0:
+            return 0.0
+        limit = self.count * p / 100.0
+        n = 0
+        for i in sorted(self.counts):
+            n += self.counts[i]
+            if n >= limit:
+                return min(max(self.value(i), self.min), self.max)
+        return self.max
+
+    def to_dict(self):
+        return {'count': self.count,
+                'min': self.min if self.count > 0 else 0.0,
+                'max': self.max,
+                'mean': self.mean,
+                'p50': self.percentile(50.0),
+                'p90': self.percentile(90.0),
+                'p99': self.percentile(99.0),
+                'p999': self.percentile(99.9)}
+
+
+class IOStats:
+    # min number of samples of a command to use its adaptive timeout
+    MIN_SAMPLES = 20
+    # adaptive timeout is recalculated after this number of new samples
+    UPDATE_SAMPLES = 16
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.io_count = 0
+        self.io_error_count = 0
+        self.retry_count = 0
+        self.timeout_count = 0
+        self.parse_error_count = 0
+        # replies received after adaptive timeout
+        self.late_count = 0
+        self.bytes_out = 0
+        self.bytes_in = 0
+        # latency of successful transactions, total and per command verb
+        self.latency = LatencyHistogram()
+        self.verbs = {}
+        # adaptive timeouts per command verb: [samples count, p99 latency]
+        self.p99 = {}
+
+    @staticmethod
+    def verb(command: bytes):
+        # key of latency profile, numeric arguments and %s placeholders are dropped, others are kept:
+        # b'VOLT 1.0;VOLT?\n' -> 'VOLT;VOLT?', b'VOLT? MAX\n' -> 'VOLT? MAX'
+        result = []
+        for c in command.split(b';'):
+            name, _, argument = c.strip().partition(b' ')
+            argument = argument.strip()
+            if argument and argument[:1] not in b'+-.0123456789%':
+                name += b' ' + argument
+            result.append(name.decode(errors='replace'))
+        return ';'.join(result)
+
+    def record(self, command: bytes, dt: float, verb: str = None):
+        # verb may be given precomputed to skip parsing of command
+        self.latency.record(dt)
+        if verb is None:
+            verb = self.verb(command)
+        h = self.verbs.get(verb)
+        if h is None:
+            h = LatencyHistogram()
+            self.verbs[verb] = h
+        h.record(dt)
+
+    def timeout(self, command: bytes, default: float, factor: float = 3.0, minimum: float = 0.0, verb: str = None):
+        # read timeout for command from its latency profile: p99 * factor clamped to [minimum, default],
+        # default if command is not known yet
+        if verb is None:
+            verb = self.verb(command)
+        h = self.verbs.get(verb)
+        if h is None or h.count < self.MIN_SAMPLES:
+            return default
+        cached = self.p99.get(verb)
+        if cached is None or h.count - cached[0] >= self.UPDATE_SAMPLES:
+            cached = [h.count, h.percentile(99.0)]
+            self.p99[verb] = cached
+        return min(max(cached[1] * factor, minimum), default)
+
+    def to_dict(self):
+        return {'io_count': self.io_count,
+                'io_error_count': self.io_error_count,
+                'retry_count': self.retry_count,
+                'timeout_count': self.timeout_count,
+                'parse_error_count': self.parse_error_count,
+                'late_count': self.late_count,
+                'bytes_out': self.bytes_out,
+                'bytes_in': self.bytes_in,
+                'latency': self.latency.to_dict(),
+                # copy first: send_command may add a verb while stats are read from other thread
+                'commands': {v: h.to_dict() for v, h in list(self.verbs.items())}}
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""Local columnar store of IT6900 readings in memory mapped chunk files"""
+import os
+import time
+from threading import Lock
+
+import numpy
+
+from config_logger import config_logger
+from log_exception import log_exception
+
+# columns of every chunk
+COLUMNS = ('time', 'voltage', 'current', 'power', 'output')
+# chunk file: header of HEADER_SIZE float64 words, then each column as capacity float64 values
+HEADER_SIZE = 8
+VERSION = 1.0
+# header words
+H_VERSION, H_CAPACITY, H_COUNT, H_FIRST, H_LAST = range(5)
+SUFFIX = '.it6900'
+
+
+class Chunk:
+    def __init__(self, file_name: str, capacity: int = 0, mode: str = 'r'):
+        # open existing chunk file, or create new one if capacity > 0
+        self.file_name = file_name
+        if capacity > 0:
+            self.data = numpy.memmap(file_name, dtype='<f8', mode='w+', shape=(HEADER_SIZE + len(COLUMNS) * capacity,))
+            self.data[H_VERSION] = VERSION
+            self.data[H_CAPACITY] = capacity
+            self.data[H_FIRST] = numpy.nan
+            self.data[H_LAST] = numpy.nan
+        else:
+            self.data = numpy.memmap(file_name, dtype='<f8', mode=mode)
+            if self.data[H_VERSION] != VERSION:
+                raise ValueError(f'Wrong chunk file {file_name}')
+        self.capacity = int(self.data[H_CAPACITY])
+        self.columns = self.data[HEADER_SIZE:].reshape(len(COLUMNS), self.capacity)
+
+    @property
+    def count(self):
+        return int(self.data[H_COUNT])
+
+    @property
+    def first(self):
+        return float(self.data[H_FIRST])
+
+    @property
+    def last(self):
+        return float(self.data[H_LAST])
+
+    def full(self):
+        return self.count >= self.capacity
+
+    def append(self, row):
+        # row is written before count, so reader never sees incomplete row
+        n = self.count
+        self.columns[:, n] = row
+        if n == 0:
+            self.data[H_FIRST] = row[0]
+        self.data[H_LAST] = row[0]
+        self.data[H_COUNT] = n + 1
+
+    def select(self, start: float, stop: float):
+        # rows with start <= time < stop as (columns, n) array copy
+        n = self.count
+        t = self.columns[0, :n]
+        i0, i1 = numpy.searchsorted(t, (start, stop))
+        return numpy.array(self.columns[:, i0:i1])
+
+    def flush(self):
+        self.data.flush()
+
+    def close(self):
+        self.data.flush()
+        self.data = None
+        self.columns = None
+
+
+def downsample(rows, max_points: int):
+    # averages (columns, n) rows in max_points groups of nearly equal size
+    # NaN of failed readings is skipped, group without finite values is NaN
+    n = rows.shape[1]
+    if max_points <= 0 or n <= max_points:
+        return rows
+    edges = numpy.linspace(0, n, max_points + 1).astype(int)[:-1]
+    finite = numpy.isfinite(rows)
+    sums = numpy.add.reduceat(numpy.where(finite, rows, 0.0), edges, axis=1)
+    counts = numpy.add.reduceat(finite.astype(float), edges, axis=1)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        return sums / counts
+
+
+class IT6900Store:
+    def __init__(self, directory: str, **kwargs):
+        # directory (str) - folder for chunk files, created if absent
+        self.directory = directory
+        self.logger = kwargs.get('logger', config_logger())
+        # file name prefix, e.g. device name, several stores may share the folder
+        self.prefix = kwargs.get('prefix', 'IT6900')
+        # rows in one chunk file
+        self.chunk_size = int(kwargs.get('chunk_size', 65536))
+        # new chunk is started after this time, s, 0.0 - only when chunk is full
+        self.rotate_period = float(kwargs.get('rotate_period', 86400.0))
+        # chunks with all rows older than retention are deleted, s, 0.0 - keep forever
+        self.retention = float(kwargs.get('retention', 30 * 86400.0))
+        # flush of active chunk to disk, s
+        self.flush_period = float(kwargs.get('flush_period', 10.0))
+        os.makedirs(directory, exist_ok=True)
+        self.lock = Lock()
+        self.chunk = None
+        self.chunk_time = 0.0
+        self.flush_time = 0.0
+        self.append_count = 0
+
+    def chunk_files(self):
+        # sorted by start time in name
+        names = [n for n in os.listdir(self.directory) if n.startswith(self.prefix + '_') and n.endswith(SUFFIX)]
+        return [os.path.join(self.directory, n) for n in sorted(names)]
+
+    def rotate(self, now: float):
+        if self.chunk is not None:
+            self.chunk.close()
+        name = self.prefix + '_' + time.strftime('%Y%m%d_%H%M%S', time.localtime(now)) + '_%06d' % (now % 1.0 * 1e6)
+        self.chunk = Chunk(os.path.join(self.directory, name + SUFFIX), self.chunk_size)
+        self.chunk_time = now
+        self.remove_old(now)
+
+    def remove_old(self, now: float):
+        if self.retention <= 0.0:
+            return
+        for file_name in self.chunk_files():
+            if self.chunk is not None and file_name == self.chunk.file_name:
+                continue
+            try:
+                chunk = Chunk(file_name)
+                last = chunk.last
+                chunk.data = None
+                if last < now - self.retention or numpy.isnan(last):
+                    os.remove(file_name)
+                    self.logger.debug('%s removed', file_name)
+            except KeyboardInterrupt:
+                raise
+            except:
+                log_exception(self.logger, f'Can not check store chunk {file_name}')
+
+    def append(self, row):
+        # row - (time, voltage, current, power, output), None values are stored as NaN
+        row = [numpy.nan if v is None else float(v) for v in row]
+        now = row[0]
+        with self.lock:
+            if self.chunk is None or self.chunk.full() or \
+                    (self.rotate_period > 0.0 and now - self.chunk_time >= self.rotate_period):
+                self.rotate(now)
+            self.chunk.append(row)
+            self.append_count += 1
+            if now - self.flush_time >= self.flush_period:
+                self.chunk.flush()
+                self.flush_time = now
+
+    def append_snapshot(self, snapshot):
+        # acquisition callback
+        if len(snapshot) <= 1:
+            # device is offline
+            return
+        self.append([snapshot.get(name) for name in COLUMNS])
+
+    def query(self, start: float, stop: float, max_points: int = 1000):
+        # dict of column lists for start <= time < stop, averaged down to max_points,
+        # None for missing values, so result is valid JSON
+        parts = []
+        with self.lock:
+            for file_name in self.chunk_files():
+                if self.chunk is not None and file_name == self.chunk.file_name:
+                    chunk = self.chunk
+                else:
+                    try:
+                        chunk = Chunk(file_name)
+                    except KeyboardInterrupt:
+                        raise
+                    except:
+                        log_exception(self.logger, f'Can not read store chunk {file_name}')
+                        continue
+                if chunk.count > 0 and chunk.first < stop and chunk.last >= start:
+                    parts.append(chunk.select(start, stop))
+        if parts:
+            rows = numpy.concatenate(parts, axis=1)
+        else:
+            rows = numpy.zeros((len(COLUMNS), 0))
+        rows = downsample(rows, max_points)
+        return {name: [None if numpy.isnan(v) else v for v in rows[i].tolist()] for i, name in enumerate(COLUMNS)}
+
+    def close(self):
+        with self.lock:
+            if self.chunk is not None:
+                self.chunk.close()
+                self.chunk = None
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""High rate voltage/current streaming from IT6900 into ring buffer"""
+import time
+from threading import Thread, Event, Lock
+
+import numpy
+
+from IT6900_Commands import COMMANDS
+
+from log_exception import log_exception
+
+
+class RingBuffer:
+    # preallocated ring buffer of rows with fixed number of columns
+    def __init__(self, size: int, columns: int = 3):
+        self.data = numpy.zeros((size, columns))
+        self.size = size
+        # index of the next row to write
+        self.index = 0
+        # number of valid rows
+        self.count = 0
+        # total number of rows appended
+        self.total = 0
+        self.lock = Lock()
+
+    def append(self, row):
+        with self.lock:
+            self.data[self.index] = row
+            self.index = (self.index + 1) % self.size
+            if self.count < self.size:
+                self.count += 1
+            self.total += 1
+
+    def clear(self):
+        with self.lock:
+            self.index = 0
+            self.count = 0
+
+    def last(self, n=None, decimation: int = 1, mode: str = 'step'):
+        # returns copy of last n rows, oldest first
+        # decimation > 1 keeps every decimation-th row ('step') or averages groups of rows ('mean')
+        with self.lock:
+            if n is None or n > self.count:
+                n = self.count
+            start = self.index - n
+            if start >= 0:
+                rows = self.data[start:self.index].copy()
+            else:
+                rows = numpy.concatenate((self.data[start:], self.data[:self.index]))
+        if decimation <= 1 or n <= 0:
+            return rows
+        if mode == 'mean':
+            m = (len(rows) // decimation) * decimation
+            # groups are aligned to the newest row
+            return rows[len(rows) - m:].reshape(-1, decimation, rows.shape[1]).mean(axis=1)
+        return rows[::-1][::decimation][::-1]
+
+
+class IT6900Stream:
+    QUERIES = (COMMANDS['voltage'], COMMANDS['current'])
+
+    def __init__(self, device, size: int = 10000, period: float = 0.0, **kwargs):
+        # device (IT6900) - power supply
+        # size (int) - ring buffer length, samples
+        # period (float) - sampling period, s, 0.0 - as fast as link allows
+        self.device = device
+        self.period = period
+        self.logger = kwargs.get('logger', device.logger)
+        # columns: time, voltage, current
+        self.buffer = RingBuffer(size, 3)
+        # functions called as callback(stream) after each sample
+        self.callbacks = list(kwargs.get('callbacks', ()))
+        self.stop_event = Event()
+        self.thread = None
+        self.start_time = 0.0
+        self.start_total = 0
+        self.error_count = 0
+
+    def start(self):
+        if self.running():
+            return
+        self.stop_event.clear()
+        self.start_time = time.time()
+        self.start_total = self.buffer.total
+        self.thread = Thread(target=self.run, name=f'IT6900 stream {self.device.port}', daemon=True)
+        self.thread.start()
+        self.logger.debug('%s Streaming started', self.device.pre)
+
+    def stop(self, timeout=None):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+        self.thread = None
+
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def run(self):
+        while not self.stop_event.is_set():
+            t0 = time.perf_counter()
+            try:
+                if not self.device.initialized():
+                    self.stop_event.wait(0.1)
+                    continue
+                voltage, current = self.device.query_many(self.QUERIES)
+                if voltage is None or current is None:
+                    self.error_count += 1
+                else:
+                    self.buffer.append((time.time(), voltage, current))
+                    for callback in self.callbacks:
+                        callback(self)
+            except KeyboardInterrupt:
+                raise
+            except:
+                self.error_count += 1
+                log_exception(self.logger, f'{self.device.pre} Streaming exception')
+            if self.period > 0.0:
+                self.stop_event.wait(max(self.period - (time.perf_counter() - t0), 0.0))
+
+    @property
+    def rate(self):
+        # mean sampling rate since start, samples/s
+        dt = time.time() - self.start_time
+        if dt <= 0.0 or not self.start_time:
+            return 0.0
+        return (self.buffer.total - self.start_total) / dt
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""Fixed size binary ring of recent IT6900 transactions for fault diagnosis"""
+import struct
+import time
+
+# stored command and response are truncated to these lengths
+COMMAND_SIZE = 48
+RESPONSE_SIZE = 48
+# record: start time (perf_counter), duration, result, attempt, command length, response length, command, response
+RECORD = struct.Struct(f'<ddBBBB{COMMAND_SIZE}s{RESPONSE_SIZE}s')
+RECORD_SIZE = RECORD.size
+
+
+class IOTrace:
+    def __init__(self, size: int = 256):
+        # size (int) - number of transactions kept
+        self.size = size
+        self.data = bytearray(RECORD_SIZE * size)
+        # total number of recorded transactions
+        self.count = 0
+
+    def record(self, command: bytes, response: bytes, t0: float, dt: float, result: bool, attempt: int = 0):
+        # called from send_command under device lock, one pack into preallocated buffer
+        if self.size <= 0:
+            return
+        RECORD.pack_into(self.data, (self.count % self.size) * RECORD_SIZE, t0, dt, result, attempt & 255,
+                         min(len(command), COMMAND_SIZE), min(len(response), RESPONSE_SIZE), command, response)
+        self.count += 1
+
+    def clear(self):
+        self.count = 0
+
+    def records(self):
+        # list of dicts, the oldest first, time is converted to epoch seconds
+        data = bytes(self.data)
+        count = self.count
+        n = min(count, self.size)
+        shift = time.time() - time.perf_counter()
+        result = []
+        for k in range(count - n, count):
+            t0, dt, ok, attempt, nc, nr, command, response = RECORD.unpack_from(data, (k % self.size) * RECORD_SIZE)
+            result.append({'time': t0 + shift, 'duration': dt, 'result': bool(ok), 'attempt': attempt,
+                           'command': command[:nc], 'response': response[:nr]})
+        return result
+
+    def dump(self):
+        # text lines for logs and Tango command output
+        lines = []
+        for r in self.records():
+            t = time.strftime('%H:%M:%S', time.localtime(r['time'])) + '.%03d' % (r['time'] % 1.0 * 1000)
+            lines.append('%s %7.2f ms %s #%d %s -> %s' % (t, r['duration'] * 1000.0, 'OK ' if r['result'] else 'ERR',
+                                                         r['attempt'], r['command'], r['response']))
+        return '\n'.join(lines)
@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+"""Transports for IT6900 besides ComPort: SCPI over raw TCP socket, traffic recorder and replay"""
+import select
+import socket
+import struct
+import time
+
+from config_logger import config_logger
+
+# default port of SCPI raw socket
+SCPI_PORT = 5025
+
+
+def parse_address(port: str, default_port: int = SCPI_PORT):
+    # 'tcp://192.168.1.10:5025' -> ('192.168.1.10', 5025), port number is optional
+    address = port.strip().partition('://')[2] or port.strip()
+    host, sep, number = address.rpartition(':')
+    if not sep or not number.isdigit():
+        return address, default_port
+    return host, int(number)
+
+
+class TcpTransport:
+    # persistent TCP connection with the same interface as ComPort,
+    # connection is restored at the next write after it has been dropped
+    def __init__(self, port: str, *args, **kwargs):
+        self.port = port
+        self.logger = kwargs.get('logger', config_logger())
+        host, number = parse_address(port, kwargs.get('tcp_port', SCPI_PORT))
+        self.host = kwargs.get('host') or host
+        self.tcp_port = number
+        self.connect_timeout = kwargs.get('connect_timeout', 1.0)
+        self.write_timeout = kwargs.get('write_timeout', 1.0)
+        # min interval between connection attempts, s
+        self.reconnect_delay = kwargs.get('reconnect_delay', 1.0)
+        self.socket = None
+        self.buffer = bytearray()
+        self.connect_time = -float('inf')
+        self.connect_count = 0
+        self.connect()
+
+    def connect(self):
+        # returns True if connected
+        if self.socket is not None:
+            return True
+        now = time.perf_counter()
+        if now - self.connect_time < self.reconnect_delay:
+            return False
+        self.connect_time = now
+        try:
+            s = socket.create_connection((self.host, self.tcp_port), self.connect_timeout)
+            s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            s.settimeout(self.write_timeout)
+            self.socket = s
+            self.connect_count += 1
+            self.logger.debug('%s Connected to %s:%s', self.port, self.host, self.tcp_port)
+            return True
+        except KeyboardInterrupt:
+            raise
+        except OSError as e:
+            self.logger.info('%s Can not connect to %s:%s %s', self.port, self.host, self.tcp_port, e)
+            return False
+
+    def disconnect(self):
+        if self.socket is None:
+            return
+        try:
+            self.socket.close()
+        except OSError:
+            pass
+        self.socket = None
+
+    def receive(self):
+        # move all received bytes to the buffer without blocking
+        while self.socket is not None:
+            try:
+                readable = select.select([self.socket], [], [], 0.0)[0]
+                if not readable:
+                    return
+                data = self.socket.recv(65536)
+            except OSError:
+                data = b''
+            if not data:
+                # connection dropped by peer
+                self.logger.info('%s Connection to %s:%s lost', self.port, self.host, self.tcp_port)
+                self.disconnect()
+                self.connect_time = -float('inf')
+                return
+            self.buffer += data
+
+    @property
+    def in_waiting(self):
+        self.receive()
+        return len(self.buffer)
+
+    def read(self, size=1, timeout=None):
+        if len(self.buffer) < size:
+            self.receive()
+        result = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return result
+
+    def write(self, data):
+        # returns number of bytes written, 0 on error
+        for attempt in range(2):
+            if not self.connect():
+                return 0
+            try:
+                self.socket.sendall(data)
+                return len(data)
+            except KeyboardInterrupt:
+                raise
+            except OSError as e:
+                self.logger.info('%s Socket write error %s', self.port, e)
+                self.disconnect()
+                # the next attempt reconnects at once
+                self.connect_time = -float('inf')
+        return 0
+
+    def reset_input_buffer(self):
+        self.receive()
+        self.buffer.clear()
+
+    def reset_output_buffer(self):
+        pass
+
+    def close(self):
+        self.disconnect()
+        self.buffer.clear()
+        return True
+
+    def ready(self):
+        return self.socket is not None
+
+
+# recording file: magic, then records of kind (b'W' - written, b'R' - read), epoch time, length and data
+RECORDING_MAGIC = b'IT6900REC1\n'
+RECORD_HEADER = struct.Struct('<cdI')
+
+
+def read_recording(file_name):
+    # list of (kind, time, data) from recording file, incomplete last record is ignored
+    with open(file_name, 'rb') as f:
+        data = f.read()
+    records = []
+    offset = 0
+    while offset < len(data):
+        if data.startswith(RECORDING_MAGIC, offset):
+            # each recording session starts with magic
+            offset += len(RECORDING_MAGIC)
+            continue
+        if offset + RECORD_HEADER.size > len(data):
+            break
+        kind, t, n = RECORD_HEADER.unpack_from(data, offset)
+        offset += RECORD_HEADER.size
+        if offset + n > len(data):
+            break
+        records.append((kind, t, data[offset:offset + n]))
+        offset += n
+    return records
+
+
+class RecordingTransport:
+    # wraps any transport and appends all written and read bytes with timestamps to file
+    def __init__(self, com, file_name: str, **kwargs):
+        self.com = com
+        self.file_name = file_name
+        self.logger = kwargs.get('logger', config_logger())
+        self.file = open(file_name, 'ab')
+        self.file.write(RECORDING_MAGIC)
+        self.record_count = 0
+
+    def record(self, kind: bytes, data: bytes):
+        if self.file is None:
+            return
+        try:
+            self.file.write(RECORD_HEADER.pack(kind, time.time(), len(data)))
+            self.file.write(data)
+            self.record_count += 1
+            if kind == b'R':
+                # complete transactions reach the file even if process is killed
+                self.file.flush()
+        except OSError as e:
+            self.logger.error('Recording to %s stopped: %s', self.file_name, e)
+            self.file = None
+
+    def write(self, data):
+        self.record(b'W', bytes(data))
+        return self.com.write(data)
+
+    def read(self, size=1, timeout=None):
+        data = self.com.read(size)
+        if data:
+            self.record(b'R', data)
+        return data
+
+    @property
+    def in_waiting(self):
+        return self.com.in_waiting
+
+    def reset_input_buffer(self):
+        return self.com.reset_input_buffer()
+
+    def reset_output_buffer(self):
+        return self.com.reset_output_buffer()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        return self.com.close()
+
+
+class ReplayTransport:
+    # plays recorded responses back with recorded delays after each write,
+    # written command is matched to the next equal command of the recording
+    def __init__(self, port: str, *args, **kwargs):
+        self.port = port
+        self.logger = kwargs.get('logger', config_logger())
+        self.file_name = kwargs.get('replay') or port.partition('://')[2]
+        # replay speed factor, 2.0 - responses come twice faster
+        self.speed = kwargs.get('replay_speed', 1.0)
+        # start from the beginning when recording is exhausted
+        self.loop = kwargs.get('replay_loop', False)
+        # (time, command, [(delay, response), ...]) for each write
+        self.transactions = []
+        for kind, t, data in read_recording(self.file_name):
+            if kind == b'W':
+                self.transactions.append((t, data, []))
+            elif self.transactions:
+                self.transactions[-1][2].append((t - self.transactions[-1][0], data))
+        self.index = 0
+        # (time when available, data) of the current transaction
+        self.pending = []
+        self.buffer = bytearray()
+        self.mismatch_count = 0
+
+    def find(self, data):
+        # index of transaction for written data starting from current position, None if recording is exhausted
+        n = len(self.transactions)
+        stop = self.index + n if self.loop else n
+        for i in range(self.index, stop):
+            if self.transactions[i % n][1] == data:
+                return i % n
+        if self.index < n:
+            # command is not in recording, replay the next transaction
+            self.mismatch_count += 1
+            return self.index
+        if self.loop and n > 0:
+            self.mismatch_count += 1
+            return 0
+        return None
+
+    def write(self, data):
+        now = time.perf_counter()
+        i = self.find(bytes(data))
+        if i is None:
+            self.pending = []
+        else:
+            self.pending = [(now + delay / self.speed, response) for delay, response in self.transactions[i][2]]
+            self.index = i + 1
+        return len(data)
+
+    def receive(self):
+        now = time.perf_counter()
+        while self.pending and self.pending[0][0] <= now:
+            self.buffer += self.pending.pop(0)[1]
+
+    @property
+    def in_waiting(self):
+        self.receive()
+        return len(self.buffer)
+
+    def read(self, size=1, timeout=None):
+        self.receive()
+        result = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return result
+
+    def reset_input_buffer(self):
+        self.receive()
+        self.buffer.clear()
+
+    def reset_output_buffer(self):
+        pass
+
+    def close(self):
+        self.pending = []
+        self.buffer.clear()
+        return True
+
+    def ready(self):
+        return True
+
+
+# transports by port name prefix, 'tcp://host:port', 'replay://file'
+TRANSPORTS = {'tcp': TcpTransport, 'replay': ReplayTransport}